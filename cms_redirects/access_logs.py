@@ -0,0 +1,155 @@
+"""
+Counting requested paths in web server access logs.
+
+Logs in the combined (or common) format, plain or gzipped, are read by a pool
+of processes.  Plain files are split into byte ranges so even a single large
+log is read in parallel; gzipped files are read whole by one process each.
+
+Each process keeps an approximate top-k summary of the paths it has seen
+(the Space-Saving algorithm), so memory stays bounded however many distinct
+paths a log contains.  The summaries are merged at the end.  A path's count
+may be overestimated by at most the summary's ``error`` but the most
+requested paths are always kept.
+"""
+import gzip
+import multiprocessing
+import os
+import re
+import urlparse
+
+LOG_RE = re.compile(r'^\S+ \S+ \S+ \[[^\]]*\] "(\S+) (\S+)[^"]*" (\d{3}) ')
+
+# Plain logs are split into ranges of this many bytes.
+SPLIT_SIZE = 64 * 1024 * 1024
+
+
+class TopPaths(object):
+    """
+    Counts of the most frequent paths, holding at most twice capacity
+    entries.  When full the least frequent half is dropped and its highest
+    count becomes the starting count of paths seen later.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.error = 0
+
+    def add(self, path, count=1):
+        if path in self.counts:
+            self.counts[path] += count
+            return
+        self.counts[path] = self.error + count
+        if len(self.counts) > self.capacity * 2:
+            self.trim()
+
+    def trim(self):
+        ordered = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        if len(ordered) > self.capacity:
+            self.error = max(self.error, ordered[self.capacity][1])
+        self.counts = dict(ordered[:self.capacity])
+
+    def merge(self, other):
+        """
+        Adds another summary's counts.  A path missing from one summary may
+        have been dropped from it, so it gets that summary's error instead.
+        """
+        counts = {}
+        for path in set(self.counts) | set(other.counts):
+            counts[path] = self.counts.get(path, self.error) + other.counts.get(path, other.error)
+        self.counts = counts
+        self.error += other.error
+        self.trim()
+
+    def most_common(self):
+        self.trim()
+        return sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))
+
+
+def parse_line(line, statuses):
+    """
+    Returns the path requested on a log line if it was a GET or HEAD
+    answered with one of statuses, otherwise None.
+    """
+    m = LOG_RE.match(line)
+    if m is None:
+        return None
+    method, target, status = m.groups()
+    if status not in statuses or method not in ('GET', 'HEAD'):
+        return None
+    if not target.startswith('/'):
+        # Absolute form, as sent to proxies.
+        parts = urlparse.urlsplit(target)
+        target = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+    return target
+
+
+def open_log(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def split_logs(paths, split_size=SPLIT_SIZE):
+    """
+    Returns (path, start, end) ranges covering every log.  An end of None
+    means the rest of the file.
+    """
+    ranges = []
+    for path in paths:
+        if path.endswith('.gz'):
+            ranges.append((path, 0, None))
+            continue
+        size = os.path.getsize(path)
+        start = 0
+        while start < size or start == 0:
+            end = start + split_size
+            ranges.append((path, start, end < size and end or None))
+            start = end
+    return ranges
+
+
+def count_range(args):
+    """
+    Counts the paths on the lines starting within one range of a log.
+    Returns a TopPaths summary.
+    """
+    path, start, end, statuses, capacity = args
+    top = TopPaths(capacity)
+    f = open_log(path)
+    try:
+        if start:
+            # The line straddling start belongs to the previous range.
+            f.seek(start - 1)
+            f.readline()
+        position = f.tell()
+        for line in f:
+            if end is not None and position >= end:
+                break
+            position += len(line)
+            requested = parse_line(line, statuses)
+            if requested is not None:
+                top.add(requested)
+    finally:
+        f.close()
+    return top
+
+
+def count_paths(paths, statuses=('404',), capacity=10000, processes=None):
+    """
+    Returns (path, count) pairs for the most requested paths in the given
+    logs that were answered with one of statuses, most requested first.
+    """
+    tasks = [(path, start, end, tuple(statuses), capacity) for path, start, end in split_logs(paths)]
+    if processes == 1 or len(tasks) == 1:
+        results = map(count_range, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(count_range, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    top = TopPaths(capacity)
+    for result in results:
+        top.merge(result)
+    return top.most_common()
@@ -1,18 +1,242 @@
+import urllib
+
+from django import forms
+from django.conf import settings
 from django.contrib import admin
-from cms_redirects.models import CMSRedirect
+from django.contrib.admin.actions import delete_selected as django_delete_selected
+from django.contrib.admin.util import unquote
+from django.contrib.admin.views.main import ChangeList
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db.models import Q
+from django.http import HttpResponseRedirect
+from django.utils.encoding import smart_str
+from django.utils.translation import ugettext_lazy as _
+
+from cms_redirects.models import CMSRedirect, MissingPath
+from cms_redirects import cache, http_cache, redirect_map
+from cms_redirects.chains import RedirectLoop, check_for_loop, flatten_site
+
+# 404 paths queued by the create_redirects action are carried in the add
+# form's url; this keeps it short.
+MISSING_QUEUE_LIMIT = 100
+
+
+class CMSRedirectForm(forms.ModelForm):
+    class Meta:
+        model = CMSRedirect
+
+    def clean(self):
+        data = self.cleaned_data
+        if data.get('site') and data.get('old_path') and data.get('match_type') == 'exact' and not data.get('page'):
+            try:
+                check_for_loop(data['site'].pk, self.instance.pk, data['old_path'], data.get('new_path'))
+            except RedirectLoop as e:
+                raise forms.ValidationError(_("This redirect would create a loop: %s") % e)
+        return data
+
+def delete_selected(modeladmin, request, queryset):
+    """
+    Django's delete action, invalidating caches again once the selected
+    redirects are deleted.
+    """
+    selected = request.POST.get('post') and list(queryset)
+    response = django_delete_selected(modeladmin, request, queryset)
+    # Returns None once the deletion is done, otherwise the confirmation page.
+    if selected and response is None:
+        modeladmin.invalidate(selected)
+    return response
+delete_selected.short_description = django_delete_selected.short_description
+
+
+def estimated_count(model):
+    """
+    Returns the database's estimate of the number of rows in a model's table,
+    or None where the backend doesn't keep one.
+    """
+    engine = connection.settings_dict['ENGINE']
+    cursor = connection.cursor()
+    if 'postgresql' in engine:
+        cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s", [model._meta.db_table])
+    elif 'mysql' in engine:
+        cursor.execute("SELECT table_rows FROM information_schema.tables "
+                       "WHERE table_schema = DATABASE() AND table_name = %s", [model._meta.db_table])
+    else:
+        return None
+    row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return None
+    return int(row[0])
+
+
+class CMSRedirectChangeList(ChangeList):
+    """
+    Searches by case-sensitive prefix, so the indexes on old_path and
+    new_path are used, and pages through large unfiltered tables using the
+    database's row estimate instead of counting every row.
+    """
+    def get_query_set(self):
+        query, self.query = self.query, ''
+        try:
+            qs = super(CMSRedirectChangeList, self).get_query_set()
+        finally:
+            self.query = query
+        for bit in query.split():
+            qs = qs.filter(Q(old_path__startswith=bit) | Q(new_path__startswith=bit))
+        return qs
+
+    def get_results(self, request):
+        estimate = estimated_count(self.model)
+        if estimate is not None and estimate >= getattr(settings, 'REDIRECT_ADMIN_ESTIMATE_COUNT', 100000):
+            # The total shown next to a search or filter counts the whole
+            # table; the paginator only calls count() on the queryset it is
+            # given, which is the whole table when nothing is filtered.
+            self.root_query_set.count = lambda: estimate
+            if not self.query_set.query.where:
+                self.query_set.count = lambda: estimate
+        super(CMSRedirectChangeList, self).get_results(request)
+        # Load the titles of every page shown in one query rather than one
+        # per row.
+        self.result_list = list(self.result_list)
+        page_ids = set(r.page_id for r in self.result_list if r.page_id)
+        if page_ids:
+            from cms.models import Title
+            titles = {}
+            # Every language is loaded so the CMS can fall back from the
+            # active one without going back to the database.
+            for title in Title.objects.filter(page__in=page_ids):
+                titles.setdefault(title.page_id, {})[title.language] = title
+            for r in self.result_list:
+                if r.page_id:
+                    r.page.title_cache = dict(titles.get(r.page_id, {}))
+
 
 class CMSRedirectAdmin(admin.ModelAdmin):
-    list_display = ('old_path', 'new_path', 'page', 'page_site', 'site', 'actual_response_code',)
-    list_filter = ('site',)
-    search_fields = ('old_path', 'new_path', 'page__title_set__title')
+    form = CMSRedirectForm
+    list_display = ('old_path', 'match_type', 'new_path', 'page', 'page_site', 'site', 'actual_response_code', 'hits', 'last_hit',)
+    list_filter = ('site', 'match_type',)
+    search_fields = ('old_path', 'new_path',)
     radio_fields = {'site': admin.VERTICAL}
+    actions = [delete_selected]
     fieldsets = [
         ('Source', {
-            "fields": ('site','old_path',)
+            "fields": ('site','old_path','match_type',)
         }),
         ('Destination', {
-            "fields": ('new_path','page', 'response_code',)
+            "fields": ('new_path','page', 'response_code', 'early', 'cache_max_age',)
         }),
     ]
 
+    def queryset(self, request):
+        return super(CMSRedirectAdmin, self).queryset(request).select_related('site', 'page', 'page__site')
+
+    def get_changelist(self, request, **kwargs):
+        return CMSRedirectChangeList
+
+    def save_model(self, request, obj, form, change):
+        obj.save()
+        # Point any redirects that now lead to another redirect straight at
+        # the final destination.
+        request.cms_redirect_saved = (obj, flatten_site(obj.site_id))
+        MissingPath.objects.filter(site=obj.site_id, path=obj.old_path).delete()
+
+    def add_view(self, request, *args, **kwargs):
+        response = super(CMSRedirectAdmin, self).add_view(request, *args, **kwargs)
+        self.redirect_committed(request)
+        return response
+
+    def response_add(self, request, obj, *args, **kwargs):
+        response = super(CMSRedirectAdmin, self).response_add(request, obj, *args, **kwargs)
+        # After a plain save, move on to the next path queued by the
+        # create_redirects action.
+        if [key for key in ('_continue', '_addanother', '_popup') if key in request.POST]:
+            return response
+        try:
+            queued = [int(pk) for pk in request.GET.get('missing', '').split(',') if pk]
+        except ValueError:
+            return response
+        url = next_missing_url(queued)
+        if url is None:
+            return response
+        self.message_user(request, _("Add a redirect for the next selected path."))
+        return HttpResponseRedirect(url)
+
+    def change_view(self, request, *args, **kwargs):
+        response = super(CMSRedirectAdmin, self).change_view(request, *args, **kwargs)
+        self.redirect_committed(request)
+        return response
+
+    def delete_view(self, request, object_id, *args, **kwargs):
+        # Fetched separately, as deleting clears the primary key.
+        obj = request.POST and self.get_object(request, unquote(object_id))
+        response = super(CMSRedirectAdmin, self).delete_view(request, object_id, *args, **kwargs)
+        if obj:
+            self.invalidate([obj])
+        return response
+
+    def redirect_committed(self, request):
+        saved = getattr(request, 'cms_redirect_saved', None)
+        if saved is not None:
+            obj, flattened = saved
+            self.invalidate([obj], flattened)
+
+    def invalidate(self, redirects, flattened=False):
+        """
+        Invalidates caches again once changes to redirects have committed,
+        as processes may have reloaded the old rows since the model signals.
+        """
+        if flattened:
+            cache.bump_version()
+            http_cache.purge_all(CMSRedirect, redirects[0].site_id)
+        elif len(redirects) == 1:
+            cache.redirect_changed(CMSRedirect, redirects[0])
+            http_cache.redirect_changed(CMSRedirect, redirects[0])
+        else:
+            paths = [(r.site_id, r.old_path, r.normalized_path) for r in redirects]
+            cache.redirects_changed(paths)
+            http_cache.purge_all(CMSRedirect)
+        redirect_map.rebuild()
+
 admin.site.register(CMSRedirect, CMSRedirectAdmin)
+
+
+def next_missing_url(queued):
+    """
+    Returns the url of the add form prefilled from the first of the queued
+    404 paths still logged, carrying the rest of the queue, or None.
+    """
+    for i, pk in enumerate(queued):
+        try:
+            missing = MissingPath.objects.get(pk=pk)
+        except MissingPath.DoesNotExist:
+            continue
+        params = [('site', missing.site_id), ('old_path', smart_str(missing.path))]
+        if queued[i + 1:]:
+            params.append(('missing', ','.join(str(pk) for pk in queued[i + 1:])))
+        return '%s?%s' % (reverse('admin:cms_redirects_cmsredirect_add'), urllib.urlencode(params))
+    return None
+
+
+def create_redirects(modeladmin, request, queryset):
+    """
+    Opens the add form for a redirect from each selected path in turn, most
+    visited first, so none goes live before a destination is chosen.  Each
+    path is removed from the 404 log when its redirect is saved.
+    """
+    queued = list(queryset.order_by('-hits').values_list('pk', flat=True)[:MISSING_QUEUE_LIMIT])
+    if len(queued) > 1:
+        modeladmin.message_user(request, _("Add a redirect for each of the %(count)d most visited selected paths in turn.")
+                                % {'count': len(queued)})
+    return HttpResponseRedirect(next_missing_url(queued))
+create_redirects.short_description = _("Create redirects for the selected paths")
+
+class MissingPathAdmin(admin.ModelAdmin):
+    list_display = ('path', 'site', 'hits', 'last_hit', 'referrer',)
+    list_filter = ('site',)
+    search_fields = ('^path',)
+    actions = [create_redirects]
+
+    def queryset(self, request):
+        return super(MissingPathAdmin, self).queryset(request).select_related('site')
+
+admin.site.register(MissingPath, MissingPathAdmin)
@@ -0,0 +1,425 @@
+"""
+In-process redirect tables.
+
+When ``REDIRECT_LOCAL_CACHE`` is enabled each worker loads the redirects for a
+site into a dict keyed on ``old_path`` the first time that site is looked up.
+The dict holds ``CompactRedirect`` records rather than model instances, with
+ASCII strings stored as byte strings and each destination stored once, so
+even very large tables fit in each worker.
+A version stamp kept in Django's cache is bumped whenever a ``CMSRedirect`` is
+saved or deleted, and every process reloads its tables once it sees a new stamp.
+
+Independently, ``REDIRECT_NEGATIVE_CACHE`` remembers paths that had no redirect
+in a bounded LRU (optionally shared through Django's cache) so repeated 404s
+for scanner noise skip the database.  Misses are recorded against the same
+version stamp, so saving a redirect makes it take effect immediately.
+
+Destination URLs of page redirects are always cached per page and language,
+since resolving them walks the CMS page tree.  They carry their own version
+stamp, bumped when any ``Page`` or ``Title`` is saved, moved, published or
+deleted, as that can change the URLs of a whole subtree.
+
+With ``REDIRECT_SITE_BY_HOST`` the site is chosen by the request's host name.
+Each process loads a map of every site's domain once, and reloads it when a
+``Site`` is saved or deleted, which bumps a separate version stamp.
+
+With ``REDIRECT_CHANGE_LOG`` the local tables follow the change log in
+``cms_redirects.change_log`` instead of the version stamp, so a single edit
+reloads only the redirects it touched.  The stamp is still bumped for
+everything else keyed on it.
+"""
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+from django.utils import translation
+
+from cms_redirects import change_log, instrumentation, normalization
+
+VERSION_KEY = 'cms_redirects:version'
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+MISS_KEY = 'cms_redirects:miss:%s:%s:%s'
+PAGE_VERSION_KEY = 'cms_redirects:page_version'
+PAGE_URL_KEY = 'cms_redirects:page_url:%s:%s:%s'
+SITE_VERSION_KEY = 'cms_redirects:site_version'
+
+# Response codes of CompactRedirects.
+RESPONSE_CODES = ('301', '302')
+CODE_INDEXES = dict((code, i) for i, code in enumerate(RESPONSE_CODES))
+
+# Keep lookups of changed paths and pages well under SQLite's limit of 999
+# query parameters.
+LOOKUP_BATCH_SIZE = 500
+
+_tables = {}
+_logged_tables = {}
+_matchers = {}
+_misses = OrderedDict()
+_misses_lock = threading.Lock()
+_page_urls = {}
+_sites = {}
+
+
+def is_enabled():
+    return getattr(settings, 'REDIRECT_LOCAL_CACHE', False)
+
+
+def get_version(key=VERSION_KEY):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, VERSION_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(key=VERSION_KEY):
+    if key == VERSION_KEY and change_log.is_enabled():
+        # A change made outside the log, so every process must reload.
+        change_log.append_reload()
+    cache.set(key, uuid.uuid4().hex, VERSION_TIMEOUT)
+
+
+def redirects_changed(paths):
+    """
+    Records that the redirects stored under paths, a list of (site_id,
+    old_path, normalized_path), were added, changed or deleted.
+    """
+    if change_log.is_enabled():
+        change_log.append(paths)
+        cache.set(VERSION_KEY, uuid.uuid4().hex, VERSION_TIMEOUT)
+    else:
+        bump_version()
+
+
+def exact_redirects(site_id, early_only=False):
+    from cms_redirects.models import CMSRedirect
+    redirects = CMSRedirect.objects.filter(site__id__exact=site_id, match_type='exact')
+    if early_only:
+        redirects = redirects.filter(early=True)
+    return redirects
+
+
+def compact_string(value):
+    """
+    Returns value as a byte string if it is ASCII.  Byte strings take a
+    fraction of the memory of unicode and compare and hash equal to it.
+    """
+    try:
+        return value.encode('ascii')
+    except UnicodeError:
+        return value
+
+
+class CompactRedirect(object):
+    """
+    The fields of an exact redirect that building its response needs, held
+    in a fraction of the memory of a model instance.  The response code is
+    kept as an index into RESPONSE_CODES.
+    """
+    __slots__ = ('pk', 'page_id', 'new_path', 'code', 'cache_max_age')
+
+    def __init__(self, pk, page_id, new_path, response_code, cache_max_age):
+        self.pk = pk
+        self.page_id = page_id
+        self.new_path = new_path
+        self.code = CODE_INDEXES.get(response_code, 0)
+        self.cache_max_age = cache_max_age
+
+    @property
+    def response_code(self):
+        return RESPONSE_CODES[self.code]
+
+
+def load_compact(redirects, key, table, destinations):
+    """
+    Adds redirects to table as CompactRedirects keyed on the key field,
+    sharing one copy of each destination through destinations.  Where several
+    redirects share a normalized key the oldest one wins.
+    """
+    instrumentation.count_query()
+    rows = redirects.order_by('-pk').values_list(key, 'pk', 'page', 'new_path', 'response_code', 'cache_max_age')
+    for path, pk, page_id, new_path, response_code, max_age in rows.iterator():
+        new_path = compact_string(new_path)
+        new_path = destinations.setdefault(new_path, new_path)
+        table[compact_string(path)] = CompactRedirect(pk, page_id, new_path, response_code, max_age)
+    return table
+
+
+def load_table(site_id, early_only=False, key='old_path'):
+    return load_compact(exact_redirects(site_id, early_only), key, {}, {})
+
+
+def get_table(site_id, early_only=False, key=None):
+    """
+    Returns the site's exact redirects keyed on ``normalized_path`` when
+    normalization is enabled, otherwise on ``old_path``, unless a key is
+    given.  Early redirects always match the raw path.
+    """
+    if key is None:
+        if normalization.is_enabled() and not early_only:
+            key = 'normalized_path'
+        else:
+            key = 'old_path'
+    if change_log.is_enabled():
+        return get_logged_table(site_id, early_only, key)
+    version = get_version()
+    entry = _tables.get((site_id, early_only, key))
+    if entry is None or entry[0] != version:
+        entry = (version, load_table(site_id, early_only, key))
+        _tables[(site_id, early_only, key)] = entry
+    return entry[1]
+
+
+def get_logged_table(site_id, early_only, key):
+    position = change_log.get_position()
+    entry = _logged_tables.get((site_id, early_only, key))
+    if entry is not None and entry[0] != position:
+        paths = change_log.get_changes(entry[0], position)
+        if paths is None:
+            entry = None
+        else:
+            apply_changes(entry[1], site_id, early_only, key, paths)
+            entry = (position, entry[1])
+            _logged_tables[(site_id, early_only, key)] = entry
+    if entry is None:
+        entry = (position, load_table(site_id, early_only, key))
+        _logged_tables[(site_id, early_only, key)] = entry
+    return entry[1]
+
+
+def apply_changes(table, site_id, early_only, key, paths):
+    """
+    Reloads the redirects stored under the logged paths into table.
+    """
+    column = key == 'old_path' and 1 or 2
+    changed = list(set(path[column] for path in paths if path[0] == site_id))
+    loaded = {}
+    destinations = {}
+    for i in range(0, len(changed), LOOKUP_BATCH_SIZE):
+        redirects = exact_redirects(site_id, early_only).filter(**{key + '__in': changed[i:i + LOOKUP_BATCH_SIZE]})
+        load_compact(redirects, key, loaded, destinations)
+    # Replace entries rather than clearing them first, so concurrent
+    # lookups never miss a redirect that still exists.
+    for changed_key in changed:
+        if changed_key in loaded:
+            table[compact_string(changed_key)] = loaded[changed_key]
+        else:
+            table.pop(changed_key, None)
+
+
+def get_early_table(site_id):
+    """
+    Returns the exact redirects to be served before url resolution: all of
+    them with ``REDIRECT_EARLY_ALL``, otherwise only those marked early.
+    """
+    if getattr(settings, 'REDIRECT_EARLY_ALL', False):
+        return get_table(site_id, key='old_path')
+    return get_table(site_id, early_only=True)
+
+
+def get_redirect(site_id, old_path):
+    return get_table(site_id).get(old_path)
+
+
+def get_matcher(site_id):
+    """
+    Returns the compiled prefix and regex rules for a site.  Matchers are
+    kept regardless of ``REDIRECT_LOCAL_CACHE`` since there are usually few
+    pattern rules and compiling them on every 404 would be wasteful.
+    """
+    from cms_redirects.matching import PatternMatcher
+    from cms_redirects.models import CMSRedirect
+    version = get_version()
+    entry = _matchers.get(site_id)
+    if entry is None or entry[0] != version:
+        instrumentation.count_query()
+        rules = CMSRedirect.objects.filter(site__id__exact=site_id).exclude(match_type='exact').order_by('pk')
+        entry = (version, PatternMatcher(rules))
+        _matchers[site_id] = entry
+    return entry[1]
+
+
+def negative_cache_enabled():
+    return getattr(settings, 'REDIRECT_NEGATIVE_CACHE', False)
+
+
+def _miss_key(version, site_id, path):
+    return MISS_KEY % (version, site_id, hashlib.md5(smart_str(path)).hexdigest())
+
+
+def _remember_locally(key, version, timeout):
+    size = getattr(settings, 'REDIRECT_NEGATIVE_CACHE_SIZE', 10000)
+    _misses_lock.acquire()
+    try:
+        _misses.pop(key, None)
+        _misses[key] = (version, time.time() + timeout)
+        while len(_misses) > size:
+            _misses.popitem(last=False)
+    finally:
+        _misses_lock.release()
+
+
+def is_known_miss(site_id, path):
+    """
+    Returns True if path was recently looked up for site_id and had no redirect.
+    """
+    version = get_version()
+    key = (site_id, path)
+    _misses_lock.acquire()
+    try:
+        entry = _misses.pop(key, None)
+        if entry is not None and entry[0] == version and entry[1] > time.time():
+            _misses[key] = entry
+            return True
+    finally:
+        _misses_lock.release()
+    if getattr(settings, 'REDIRECT_NEGATIVE_CACHE_SHARED', False):
+        if cache.get(_miss_key(version, site_id, path)):
+            timeout = getattr(settings, 'REDIRECT_NEGATIVE_CACHE_TIMEOUT', 300)
+            _remember_locally(key, version, timeout)
+            return True
+    return False
+
+
+def remember_miss(site_id, path):
+    version = get_version()
+    timeout = getattr(settings, 'REDIRECT_NEGATIVE_CACHE_TIMEOUT', 300)
+    _remember_locally((site_id, path), version, timeout)
+    if getattr(settings, 'REDIRECT_NEGATIVE_CACHE_SHARED', False):
+        cache.set(_miss_key(version, site_id, path), True, timeout)
+
+
+def get_page_url(page_id):
+    """
+    Returns the absolute url of a CMS page in the active language.
+    """
+    version = get_version(PAGE_VERSION_KEY)
+    language = translation.get_language()
+    entry = _page_urls.get((page_id, language))
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    key = PAGE_URL_KEY % (version, page_id, language)
+    url = cache.get(key)
+    if url is None:
+        from cms.models import Page
+        url = Page.objects.get(pk=page_id).get_absolute_url()
+        cache.set(key, url, VERSION_TIMEOUT)
+    _page_urls[(page_id, language)] = (version, url)
+    return url
+
+
+def get_page_urls(page_ids):
+    """
+    Returns a dict of page id -> absolute url for several CMS pages at once,
+    loading the pages and their titles in bulk for any that aren't cached.
+    """
+    version = get_version(PAGE_VERSION_KEY)
+    language = translation.get_language()
+    urls = {}
+    missing = []
+    for page_id in set(page_ids):
+        entry = _page_urls.get((page_id, language))
+        if entry is not None and entry[0] == version:
+            urls[page_id] = entry[1]
+        else:
+            missing.append(page_id)
+    if not missing:
+        return urls
+
+    keys = dict((PAGE_URL_KEY % (version, page_id, language), page_id) for page_id in missing)
+    found = cache.get_many(keys.keys())
+    for key, url in found.items():
+        urls[keys[key]] = url
+    missing = [page_id for page_id in missing if page_id not in urls]
+    if missing:
+        from cms.models import Page, Title
+        loaded = {}
+        for i in range(0, len(missing), LOOKUP_BATCH_SIZE):
+            batch = missing[i:i + LOOKUP_BATCH_SIZE]
+            pages = Page.objects.in_bulk(batch)
+            for title in Title.objects.filter(page__in=batch, language=language):
+                page = pages[title.page_id]
+                if not hasattr(page, 'title_cache'):
+                    page.title_cache = {}
+                page.title_cache[language] = title
+            for page_id, page in pages.items():
+                urls[page_id] = page.get_absolute_url()
+                loaded[PAGE_URL_KEY % (version, page_id, language)] = urls[page_id]
+        cache.set_many(loaded, VERSION_TIMEOUT)
+
+    for page_id, url in urls.items():
+        _page_urls[(page_id, language)] = (version, url)
+    return urls
+
+
+def site_by_host_enabled():
+    return getattr(settings, 'REDIRECT_SITE_BY_HOST', False)
+
+
+def get_site_id(host):
+    """
+    Returns the id of the site whose domain is host, with or without its
+    port, or settings.SITE_ID if there is none.
+    """
+    domains = get_domains()
+    host = host.lower()
+    site_id = domains.get(host)
+    if site_id is None:
+        site_id = domains.get(host.rsplit(':', 1)[0], settings.SITE_ID)
+    return site_id
+
+
+def get_domains():
+    """
+    Returns a dict of lowercased domain -> site id for every site.
+    """
+    version = get_version(SITE_VERSION_KEY)
+    entry = _sites.get('domains')
+    if entry is None or entry[0] != version:
+        from django.contrib.sites.models import Site
+        entry = (version, dict((domain.lower(), pk) for pk, domain in
+                               Site.objects.values_list('pk', 'domain')))
+        _sites['domains'] = entry
+    return entry[1]
+
+
+def clear():
+    _tables.clear()
+    _logged_tables.clear()
+    _matchers.clear()
+    _page_urls.clear()
+    _sites.clear()
+    _misses_lock.acquire()
+    try:
+        _misses.clear()
+    finally:
+        _misses_lock.release()
+
+
+def remember_paths(sender, instance, **kwargs):
+    """
+    Keeps the paths a redirect was stored under before it is saved, so the
+    change log can list them.
+    """
+    if change_log.is_enabled() and instance.pk:
+        instance._previous_paths = list(sender.objects.filter(pk=instance.pk).values_list(
+            'site', 'old_path', 'normalized_path'))
+
+
+def redirect_changed(sender, instance, **kwargs):
+    paths = [(instance.site_id, instance.old_path, instance.normalized_path)]
+    paths.extend(getattr(instance, '_previous_paths', []))
+    redirects_changed(paths)
+
+
+def page_changed(sender, instance, **kwargs):
+    bump_version(PAGE_VERSION_KEY)
+
+
+def site_changed(sender, instance, **kwargs):
+    bump_version(SITE_VERSION_KEY)
@@ -0,0 +1,89 @@
+"""
+Redirect chain flattening and loop detection.
+
+A chain is a path redirect whose destination is the source of another path
+redirect on the same site.  Chains are resolved for a whole site in one pass
+over its redirects, visiting each one once.
+"""
+UPDATE_BATCH_SIZE = 500
+
+UNVISITED, IN_PROGRESS, DONE = 0, 1, 2
+
+
+class RedirectLoop(Exception):
+    def __init__(self, paths):
+        self.paths = paths
+        Exception.__init__(self, " -> ".join(paths + paths[:1]))
+
+
+def find_final_destinations(redirects):
+    """
+    Takes a dict of old_path -> new_path and returns a dict holding the final
+    destination of every redirect whose destination is itself redirected.
+    Raises RedirectLoop if the redirects contain a cycle.
+    """
+    state = {}
+    final = {}
+    for start in redirects:
+        if state.get(start, UNVISITED) != UNVISITED:
+            continue
+        path = []
+        node = start
+        while node in redirects and state.get(node, UNVISITED) == UNVISITED:
+            state[node] = IN_PROGRESS
+            path.append(node)
+            node = redirects[node]
+        if state.get(node) == IN_PROGRESS:
+            raise RedirectLoop(path[path.index(node):])
+        end = final.get(node, node)
+        for source in path:
+            state[source] = DONE
+            final[source] = end
+    return dict((source, end) for source, end in final.items()
+                if end != redirects[source])
+
+
+def get_site_redirects(site_id, exclude_pk=None):
+    """
+    Returns a dict of pk -> (old_path, new_path) for the redirects of a site
+    that can form part of a chain: exact matches pointing at a path.
+    """
+    from cms_redirects.models import CMSRedirect
+    redirects = CMSRedirect.objects.filter(site__id__exact=site_id, match_type='exact',
+                                           page__isnull=True).exclude(new_path='')
+    if exclude_pk is not None:
+        redirects = redirects.exclude(pk=exclude_pk)
+    return dict((pk, (old_path, new_path)) for pk, old_path, new_path
+                in redirects.values_list('pk', 'old_path', 'new_path'))
+
+
+def check_for_loop(site_id, pk, old_path, new_path):
+    """
+    Raises RedirectLoop if saving a redirect from old_path to new_path would
+    create a cycle on the site.
+    """
+    redirects = dict(get_site_redirects(site_id, exclude_pk=pk).values())
+    if new_path:
+        redirects[old_path] = new_path
+    find_final_destinations(redirects)
+
+
+def flatten_site(site_id):
+    """
+    Rewrites every chained redirect on a site to point at its final
+    destination.  Returns the number of redirects changed.  Raises
+    RedirectLoop if the site's redirects contain a cycle.
+    """
+    from cms_redirects.models import CMSRedirect
+    rows = get_site_redirects(site_id)
+    final = find_final_destinations(dict(rows.values()))
+    if not final:
+        return 0
+    updates = {}
+    for pk, (old_path, new_path) in rows.items():
+        if old_path in final:
+            updates.setdefault(final[old_path], []).append(pk)
+    for new_path, pks in updates.items():
+        for i in range(0, len(pks), UPDATE_BATCH_SIZE):
+            CMSRedirect.objects.filter(pk__in=pks[i:i + UPDATE_BATCH_SIZE]).update(new_path=new_path)
+    return len(final)
@@ -0,0 +1,100 @@
+"""
+A log of redirect changes kept in Django's cache.
+
+With ``REDIRECT_CHANGE_LOG`` enabled, saving or deleting a ``CMSRedirect``
+appends an entry listing the paths it was and is stored under, instead of
+making every process reload its local tables.  Each process remembers the
+sequence number its tables were loaded at and, on its next lookup, reloads
+only the redirects stored under the paths logged since.
+
+Entries expire after ``ENTRY_TIMEOUT`` and may be evicted at any time.  A
+process that finds one missing, finds that more than ``REDIRECT_CHANGE_LOG_SIZE``
+paths changed, or finds a change made outside the log, such as a bulk import
+flattening chains, reloads its tables in full.  Any cache backend shared by
+the processes will do, locmem included for a single process.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+EPOCH_KEY = 'cms_redirects:log_epoch'
+SEQUENCE_KEY = 'cms_redirects:log_sequence'
+ENTRY_KEY = 'cms_redirects:log:%s:%d'
+ENTRY_TIMEOUT = 60 * 60 * 24
+LOG_TIMEOUT = 60 * 60 * 24 * 30
+
+# Stored in place of the paths of a change that wasn't logged.
+RELOAD = 'reload'
+
+
+def is_enabled():
+    return getattr(settings, 'REDIRECT_CHANGE_LOG', False)
+
+
+def get_size():
+    return getattr(settings, 'REDIRECT_CHANGE_LOG_SIZE', 1000)
+
+
+def start():
+    """
+    Starts a new log, making every process reload its tables.
+    """
+    epoch = uuid.uuid4().hex
+    cache.set(SEQUENCE_KEY, 0, LOG_TIMEOUT)
+    cache.set(EPOCH_KEY, epoch, LOG_TIMEOUT)
+    return epoch, 0
+
+
+def get_position():
+    """
+    Returns the (epoch, sequence number) of the latest entry in the log.
+    """
+    values = cache.get_many([EPOCH_KEY, SEQUENCE_KEY])
+    if len(values) < 2:
+        return start()
+    return values[EPOCH_KEY], values[SEQUENCE_KEY]
+
+
+def append(paths):
+    """
+    Logs a change to the redirects stored under paths, a list of (site_id,
+    old_path, normalized_path).  Too many paths are logged as a reload.
+    """
+    if paths != RELOAD and len(paths) > get_size():
+        paths = RELOAD
+    epoch = get_position()[0]
+    try:
+        sequence = cache.incr(SEQUENCE_KEY)
+    except ValueError:
+        # The sequence was evicted since it was read.
+        epoch, sequence = start()
+        sequence = cache.incr(SEQUENCE_KEY)
+    cache.set(ENTRY_KEY % (epoch, sequence), paths, ENTRY_TIMEOUT)
+
+
+def append_reload():
+    append(RELOAD)
+
+
+def get_changes(since, until):
+    """
+    Returns the paths logged after position since up to position until, or
+    None if the tables must be reloaded instead.
+    """
+    epoch, first = since
+    if until[0] != epoch or until[1] < first:
+        return None
+    if until[1] - first > get_size():
+        return None
+    keys = [ENTRY_KEY % (epoch, sequence) for sequence in range(first + 1, until[1] + 1)]
+    entries = cache.get_many(keys)
+    paths = []
+    for key in keys:
+        entry = entries.get(key)
+        if entry is None or entry == RELOAD:
+            return None
+        paths.extend(entry)
+    if len(paths) > get_size():
+        return None
+    return paths
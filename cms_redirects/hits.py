@@ -0,0 +1,81 @@
+"""
+Batched hit counting.
+
+When ``REDIRECT_COUNT_HITS`` is enabled the middleware records each redirect
+it serves in a per-process buffer.  The buffer is written out with a single
+``UPDATE`` per batch once it holds ``REDIRECT_HITS_FLUSH_SIZE`` redirects or
+``REDIRECT_HITS_FLUSH_INTERVAL`` seconds have passed since the last flush.
+"""
+import atexit
+import datetime
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+
+# Each redirect in a batch uses five query parameters; keep well under
+# SQLite's limit of 999.
+FLUSH_BATCH_SIZE = 150
+
+_buffer = {}
+_lock = threading.Lock()
+_last_flush = [time.time()]
+
+
+def is_enabled():
+    return getattr(settings, 'REDIRECT_COUNT_HITS', False)
+
+
+def record_hit(pk):
+    now = datetime.datetime.now()
+    _lock.acquire()
+    try:
+        entry = _buffer.get(pk)
+        if entry is None:
+            _buffer[pk] = [1, now]
+        else:
+            entry[0] += 1
+            entry[1] = now
+        size = len(_buffer)
+    finally:
+        _lock.release()
+    if (size >= getattr(settings, 'REDIRECT_HITS_FLUSH_SIZE', 100) or
+            time.time() - _last_flush[0] >= getattr(settings, 'REDIRECT_HITS_FLUSH_INTERVAL', 60)):
+        flush()
+
+
+def flush():
+    """
+    Writes the buffered hits to the database.
+    """
+    global _buffer
+    _lock.acquire()
+    try:
+        pending, _buffer = _buffer, {}
+        _last_flush[0] = time.time()
+    finally:
+        _lock.release()
+    if not pending:
+        return
+
+    from cms_redirects.models import CMSRedirect
+    table = connection.ops.quote_name(CMSRedirect._meta.db_table)
+    cursor = connection.cursor()
+    items = list(pending.items())
+    for i in range(0, len(items), FLUSH_BATCH_SIZE):
+        batch = items[i:i + FLUSH_BATCH_SIZE]
+        cases = " ".join(["WHEN %s THEN %s"] * len(batch))
+        placeholders = ", ".join(["%s"] * len(batch))
+        sql = ("UPDATE %s SET hits = hits + CASE id %s END, last_hit = CASE id %s END WHERE id IN (%s)"
+               % (table, cases, cases, placeholders))
+        params = []
+        for pk, (count, last_hit) in batch:
+            params.extend([pk, count])
+        for pk, (count, last_hit) in batch:
+            params.extend([pk, last_hit])
+        params.extend([pk for pk, entry in batch])
+        cursor.execute(sql, params)
+    transaction.commit_unless_managed()
+
+atexit.register(flush)
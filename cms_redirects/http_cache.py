@@ -0,0 +1,58 @@
+"""
+Caching headers for redirect responses.
+
+``REDIRECT_CACHE_MAX_AGE`` maps a response code ('301', '302' or '410') to
+the number of seconds the response may be cached, sent as ``Cache-Control``
+and ``Expires``.  A redirect's own ``cache_max_age`` takes precedence.
+Responses for codes that aren't listed are left without caching headers.
+
+With ``REDIRECT_SURROGATE_KEY_HEADER`` (e.g. ``Surrogate-Key`` for Fastly,
+``Cache-Tag`` for Cloudflare or ``xkey`` for Varnish) each response is also
+tagged with a key shared by every redirect and one for the redirect itself.
+Connect to ``cms_redirects.signals.redirect_purge`` to purge those keys
+when redirects change.
+"""
+import time
+
+from django.conf import settings
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date
+
+from cms_redirects.signals import redirect_purge
+
+ALL_KEY = 'cms-redirects'
+REDIRECT_KEY = 'cms-redirect-%s'
+
+
+def get_max_age(r, response_code):
+    max_age = getattr(r, 'cache_max_age', None)
+    if max_age is None:
+        max_age = getattr(settings, 'REDIRECT_CACHE_MAX_AGE', {}).get(response_code)
+    return max_age
+
+
+def patch_response(response, r):
+    """
+    Adds the caching and surrogate key headers for redirect r to response.
+    """
+    max_age = get_max_age(r, str(response.status_code))
+    if max_age is not None:
+        patch_cache_control(response, public=True, max_age=max_age)
+        response['Expires'] = http_date(time.time() + max_age)
+    header = getattr(settings, 'REDIRECT_SURROGATE_KEY_HEADER', None)
+    if header:
+        response[header] = '%s %s' % (ALL_KEY, REDIRECT_KEY % r.pk)
+    return response
+
+
+def redirect_changed(sender, instance, **kwargs):
+    redirect_purge.send(sender=sender, keys=[REDIRECT_KEY % instance.pk],
+                        paths=[instance.old_path], site_id=instance.site_id)
+
+
+def purge_all(sender, site_id=None):
+    """
+    Asks for every cached redirect response to be purged, after changes
+    that don't go through CMSRedirect.save.
+    """
+    redirect_purge.send(sender=sender, keys=[ALL_KEY], paths=[], site_id=site_id)
@@ -0,0 +1,169 @@
+"""
+Checking a redirect import before it is applied.
+
+``check_import`` compares the rows of an import file with the redirects
+already on their sites and returns a report of the redirects that would be
+added or changed, existing redirects the file leaves alone, sources listed
+more than once, invalid urls or response codes and chains and loops the
+import would create.  Rows are validated by a pool of processes when there
+are many of them.
+"""
+import multiprocessing
+
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
+
+from cms_redirects.chains import RedirectLoop, find_final_destinations
+from cms_redirects.matching import check_rule
+
+MAX_PATH_LENGTH = 200
+
+# Files with fewer rows than this are validated in process.
+PARALLEL_THRESHOLD = 20000
+VALIDATE_CHUNK_SIZE = 5000
+
+RESPONSE_CODES = ('', '301', '302', '410')
+MATCH_TYPES = ('', 'exact', 'prefix', 'regex')
+
+
+def validate_row(line, old_url, new_url, response_code, match_type=''):
+    """
+    Returns a list of (line, message) problems with one row.
+    """
+    problems = []
+    if match_type not in MATCH_TYPES:
+        problems.append((line, "Unknown match type %r" % match_type))
+    problem = check_rule(match_type, old_url, new_url)
+    if problem:
+        problems.append((line, "Invalid %s rule: %s" % (match_type, problem)))
+    if match_type != 'regex':
+        if not old_url.startswith('/'):
+            problems.append((line, "Old Url must be an absolute path: %r" % old_url))
+        elif len(old_url.split()) != 1:
+            problems.append((line, "Old Url contains whitespace: %r" % old_url))
+    if len(old_url) > MAX_PATH_LENGTH:
+        problems.append((line, "Old Url is longer than %d characters" % MAX_PATH_LENGTH))
+    if new_url:
+        if len(new_url) > MAX_PATH_LENGTH:
+            problems.append((line, "New Url is longer than %d characters" % MAX_PATH_LENGTH))
+        if new_url.startswith('/'):
+            if len(new_url.split()) != 1:
+                problems.append((line, "New Url contains whitespace: %r" % new_url))
+        else:
+            try:
+                URLValidator()(new_url)
+            except ValidationError:
+                problems.append((line, "New Url is neither a path nor a valid url: %r" % new_url))
+    if response_code not in RESPONSE_CODES:
+        problems.append((line, "Unknown response code %r, would be imported as 301" % response_code))
+    return problems
+
+
+def validate_chunk(rows):
+    problems = []
+    for line, site_id, old_url, new_url, response_code, match_type in rows:
+        problems.extend(validate_row(line, old_url, new_url, response_code, match_type))
+    return problems
+
+
+def validate_rows(rows, processes=None):
+    """
+    Validates (line, site_id, old_url, new_url, response_code, match_type) rows,
+    spreading them over a pool of processes if there are many.
+    """
+    chunks = [rows[i:i + VALIDATE_CHUNK_SIZE] for i in range(0, len(rows), VALIDATE_CHUNK_SIZE)]
+    if processes == 1 or len(rows) < PARALLEL_THRESHOLD:
+        results = map(validate_chunk, chunks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(validate_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    problems = []
+    for result in results:
+        problems.extend(result)
+    return problems
+
+
+def would_change(existing, new_url, response_code, match_type):
+    """
+    Returns whether importing a row changes where an existing redirect,
+    given as (new_path, response_code, page_id, match_type), sends requests.
+    The import keeps the redirect's page, which wins over its new path.
+    """
+    old_url, old_response_code, page_id, old_match_type = existing
+    if page_id:
+        return (old_response_code, old_match_type) != (response_code, match_type)
+    return (old_url, old_response_code, old_match_type) != (new_url, response_code, match_type)
+
+
+class ImportReport(object):
+    def __init__(self):
+        self.added = []
+        self.changed = []
+        self.unchanged = 0
+        self.not_in_file = 0
+        self.duplicates = []
+        self.invalid = []
+        self.chains = 0
+        self.loops = []
+
+
+def check_import(rows, processes=None):
+    """
+    Takes (line, site_id, old_url, new_url, response_code, match_type) rows
+    as they would be imported, later rows winning, and returns an
+    ImportReport.  An empty match type means an exact path.
+    """
+    from cms_redirects.models import CMSRedirect
+    report = ImportReport()
+    report.invalid = validate_rows(rows, processes)
+
+    by_site = {}
+    for line, site_id, old_url, new_url, response_code, match_type in rows:
+        imported = by_site.setdefault(site_id, {})
+        if old_url in imported:
+            report.duplicates.append((line, imported[old_url][0], old_url))
+        if response_code not in ('301', '302'):
+            response_code = '301'
+        imported[old_url] = (line, new_url, response_code, match_type or 'exact')
+
+    for site_id, imported in by_site.items():
+        existing = {}
+        chains = {}
+        redirects = CMSRedirect.objects.filter(site__id__exact=site_id).values_list(
+            'old_path', 'new_path', 'response_code', 'page', 'match_type')
+        for old_url, new_url, response_code, page_id, match_type in redirects.iterator():
+            existing[old_url] = (new_url, response_code, page_id, match_type)
+            if match_type == 'exact' and not page_id and new_url:
+                chains[old_url] = new_url
+
+        for old_url, (line, new_url, response_code, match_type) in sorted(imported.items(), key=lambda item: item[1][0]):
+            page_id = None
+            if old_url not in existing:
+                report.added.append((line, old_url, new_url))
+            else:
+                page_id = existing[old_url][2]
+                if would_change(existing[old_url], new_url, response_code, match_type):
+                    report.changed.append((line, old_url, existing[old_url][0], new_url))
+                else:
+                    report.unchanged += 1
+            if new_url and match_type == 'exact' and not page_id:
+                chains[old_url] = new_url
+            else:
+                chains.pop(old_url, None)
+            existing.pop(old_url, None)
+        report.not_in_file += len(existing)
+
+        # A loop is reported, then removed so any further loops are found.
+        while True:
+            try:
+                report.chains += len(find_final_destinations(chains))
+                break
+            except RedirectLoop as e:
+                report.loops.append((site_id, e.paths))
+                for path in e.paths:
+                    chains.pop(path, None)
+    return report
@@ -0,0 +1,79 @@
+"""
+Instrumentation of redirect lookups.
+
+Each lookup sends ``cms_redirects.signals.redirect_lookup``, but only while
+the signal has receivers, so there is no timing or bookkeeping overhead when
+nothing listens.  Receivers can be connected directly or listed as dotted
+paths in ``REDIRECT_LOOKUP_RECEIVERS``; ``log_lookup`` and ``statsd_lookup``
+are included.
+"""
+import logging
+import socket
+import threading
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+from cms_redirects.signals import redirect_lookup
+
+EXACT = 'exact'
+NO_SLASH = 'no_slash'
+NO_QUERY = 'no_query'
+NO_SLASH_NO_QUERY = 'no_slash_no_query'
+PATTERN = 'pattern'
+EARLY = 'early'
+
+logger = logging.getLogger('cms_redirects')
+
+_local = threading.local()
+
+
+def is_enabled():
+    return bool(redirect_lookup.receivers)
+
+
+def count_query():
+    """
+    Called wherever a lookup queries the database.
+    """
+    _local.queries = getattr(_local, 'queries', 0) + 1
+
+
+def query_count():
+    return getattr(_local, 'queries', 0)
+
+
+def connect_receivers():
+    for path in getattr(settings, 'REDIRECT_LOOKUP_RECEIVERS', ()):
+        module, name = path.rsplit('.', 1)
+        redirect_lookup.connect(getattr(import_module(module), name), dispatch_uid=path)
+
+
+def log_lookup(sender, path, site_id, redirect, strategy, duration, queries, cache, **kwargs):
+    logger.info("redirect lookup site=%s path=%s strategy=%s cache=%s queries=%d duration=%.2fms",
+                site_id, path, strategy or 'miss', cache, queries, duration * 1000)
+
+
+_statsd_socket = []
+
+
+def statsd_lookup(sender, path, site_id, redirect, strategy, duration, queries, cache, **kwargs):
+    """
+    Sends the lookup time and counters for the strategy and cache outcome to
+    the StatsD server at ``REDIRECT_STATSD_HOST``/``REDIRECT_STATSD_PORT``.
+    """
+    prefix = getattr(settings, 'REDIRECT_STATSD_PREFIX', 'cms_redirects')
+    address = (getattr(settings, 'REDIRECT_STATSD_HOST', 'localhost'),
+               getattr(settings, 'REDIRECT_STATSD_PORT', 8125))
+    metrics = [
+        "%s.lookup:%.3f|ms" % (prefix, duration * 1000),
+        "%s.strategy.%s:1|c" % (prefix, strategy or 'miss'),
+        "%s.cache.%s:1|c" % (prefix, cache),
+        "%s.queries:%d|c" % (prefix, queries),
+    ]
+    if not _statsd_socket:
+        _statsd_socket.append(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+    try:
+        _statsd_socket[0].sendto("\n".join(metrics), address)
+    except socket.error:
+        pass
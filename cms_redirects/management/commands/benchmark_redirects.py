@@ -0,0 +1,289 @@
+import StringIO
+import csv
+import os
+import random
+import sys
+import tempfile
+import time
+import platform
+from optparse import make_option
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.sites.models import Site
+from django.conf import settings
+from django.db import connection, reset_queries, transaction
+from django.utils import simplejson
+
+import cms_redirects
+from cms_redirects import cache
+from cms_redirects.models import CMSRedirect
+from cms_redirects.middleware import find_redirect, build_response
+from cms_redirects.normalization import normalize
+
+MODES = {
+    'uncached': {},
+    'local_cache': {'REDIRECT_LOCAL_CACHE': True},
+    'negative_cache': {'REDIRECT_NEGATIVE_CACHE': True},
+    'normalized': {'REDIRECT_NORMALIZE': True},
+}
+
+
+class Command(BaseCommand):
+    can_import_settings = True
+    help='''
+
+    Benchmarks redirect lookups and imports against synthetic redirect tables
+    and prints the results as JSON, so runs against different versions can be
+    compared.  Everything runs in a throwaway test database.
+
+    Usage:
+    ./manage.py benchmark_redirects --sizes=1000,100000 > before.json
+
+    '''
+    option_list = BaseCommand.option_list + (
+            make_option('--sizes',
+                dest="sizes",
+                default="1000,10000",
+                help="Comma separated numbers of redirects to generate per run.  Defaults to 1000,10000"),
+            make_option('--sites',
+                dest="num_sites",
+                default=3,
+                help="Number of sites the redirects are spread over.  Defaults to 3"),
+            make_option('--lookups',
+                dest="num_lookups",
+                default=1000,
+                help="Number of hits and of misses to time per mode.  Defaults to 1000"),
+            make_option('--modes',
+                dest="modes",
+                default=",".join(sorted(MODES)),
+                help="Comma separated lookup modes to run: %s" % ", ".join(sorted(MODES))),
+            make_option('--output',
+                dest="output",
+                default=None,
+                help="File to write the results to.  Defaults to stdout."),
+            make_option('--seed',
+                dest="seed",
+                default=0,
+                help="Random seed used to generate the redirect tables"),
+            )
+
+    def execute(self, *args, **options):
+        sizes = [int(size) for size in options["sizes"].split(",")]
+        modes = options["modes"].split(",")
+        for mode in modes:
+            if mode not in MODES:
+                raise CommandError("Unknown mode: %s" % mode)
+
+        try:
+            from south.management.commands import patch_for_test_db_setup
+        except ImportError:
+            pass
+        else:
+            patch_for_test_db_setup()
+        old_name = settings.DATABASES['default']['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            results = []
+            for size in sizes:
+                random.seed(int(options["seed"]))
+                sites = create_sites(int(options["num_sites"]))
+                generate_redirects(sites, size)
+                for mode in modes:
+                    results.append(benchmark_lookups(sites, size, mode, int(options["num_lookups"])))
+                results.append(benchmark_import(sites[0], size, bulk=True))
+                if size <= 10000:
+                    results.append(benchmark_import(sites[0], size, bulk=False))
+                delete_redirects()
+        finally:
+            settings.DEBUG = old_debug
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = {
+            'version': cms_redirects.__version__,
+            'python': platform.python_version(),
+            'database': settings.DATABASES['default']['ENGINE'],
+            'results': results,
+        }
+        if options["output"]:
+            output = open(options["output"], "w")
+        else:
+            output = sys.stdout
+        output.write(simplejson.dumps(report, indent=2, sort_keys=True))
+        output.write("\n")
+
+
+def create_sites(num_sites):
+    sites = [Site.objects.get_current()]
+    for i in range(1, num_sites):
+        site, created = Site.objects.get_or_create(domain='site%d.example.com' % i, name='site%d' % i)
+        sites.append(site)
+    return sites
+
+
+def create_pages(site, num_pages):
+    from cms.models import Page
+    pages = []
+    for i in range(num_pages):
+        page = Page(site=site)
+        page.save()
+        pages.append(page)
+    return pages
+
+
+def synthetic_path(i):
+    """
+    Returns a legacy path, varying trailing slashes and query strings.
+    """
+    kind = i % 4
+    if kind == 0:
+        return '/legacy/%d.html' % i
+    if kind == 1:
+        return '/legacy/%d/' % i
+    if kind == 2:
+        return '/legacy/item?id=%d' % i
+    return '/legacy/%d' % i
+
+
+@transaction.commit_on_success
+def generate_redirects(sites, size):
+    """
+    Inserts size redirects spread over sites.  One in ten points at a page,
+    one in fifty is a 410 and one in ten is a 302.
+    """
+    table = connection.ops.quote_name(CMSRedirect._meta.db_table)
+    sql = ("INSERT INTO %s (site_id, old_path, normalized_path, match_type, new_path, page_id, response_code, early, hits) "
+           "VALUES (%%s, %%s, %%s, 'exact', %%s, %%s, %%s, %%s, 0)" % table)
+    pages = dict((site.pk, create_pages(site, 5)) for site in sites)
+    cursor = connection.cursor()
+    rows = []
+    for i in range(size):
+        site = sites[i % len(sites)]
+        page_id = None
+        new_path = '/new/%d/' % i
+        if i % 10 == 0:
+            page_id = random.choice(pages[site.pk]).pk
+            new_path = ''
+        elif i % 50 == 1:
+            new_path = ''
+        response_code = i % 10 == 3 and '302' or '301'
+        old_path = synthetic_path(i)
+        rows.append((site.pk, old_path, normalize(old_path), new_path, page_id, response_code, False))
+        if len(rows) >= 1000:
+            cursor.executemany(sql, rows)
+            rows = []
+    if rows:
+        cursor.executemany(sql, rows)
+    transaction.set_dirty()
+    cache.bump_version()
+
+
+def request_paths(sites, size, num_lookups):
+    """
+    Returns the paths to look up on the current site: hits, some of which
+    only match through the slash or query string fallbacks, and misses.
+    """
+    site_index = sites.index(Site.objects.get_current())
+    own = [i for i in range(site_index, size, len(sites))]
+    hits = []
+    for n in range(num_lookups):
+        i = random.choice(own)
+        path = synthetic_path(i)
+        if n % 3 == 1 and '?' not in path:
+            path += '?utm_source=benchmark'
+        hits.append(path)
+    misses = ['/missing/%d.php' % random.randint(0, num_lookups) for n in range(num_lookups)]
+    return hits, misses
+
+
+def time_lookups(paths):
+    reset_queries()
+    start = time.time()
+    found = 0
+    for path in paths:
+        r = find_redirect(path)
+        if r is not None:
+            build_response(r)
+            found += 1
+    elapsed = time.time() - start
+    return elapsed, len(connection.queries), found
+
+
+def benchmark_lookups(sites, size, mode, num_lookups):
+    old_settings = {}
+    for name in ('REDIRECT_LOCAL_CACHE', 'REDIRECT_NEGATIVE_CACHE', 'REDIRECT_NORMALIZE', 'REDIRECT_COUNT_HITS'):
+        old_settings[name] = getattr(settings, name, False)
+        setattr(settings, name, MODES[mode].get(name, False))
+    cache.clear()
+    cache.bump_version(cache.PAGE_VERSION_KEY)
+    try:
+        hits, misses = request_paths(sites, size, num_lookups)
+        warm_start = time.time()
+        find_redirect(hits[0])
+        warmup = time.time() - warm_start
+        hit_time, hit_queries, found = time_lookups(hits)
+        miss_time, miss_queries, ignored = time_lookups(misses)
+    finally:
+        for name, value in old_settings.items():
+            setattr(settings, name, value)
+    return {
+        'benchmark': 'lookup',
+        'mode': mode,
+        'rows': size,
+        'sites': len(sites),
+        'warmup_ms': warmup * 1000,
+        'hits': len(hits),
+        'hits_found': found,
+        'hit_mean_ms': hit_time * 1000 / len(hits),
+        'queries_per_hit': float(hit_queries) / len(hits),
+        'misses': len(misses),
+        'miss_mean_ms': miss_time * 1000 / len(misses),
+        'queries_per_miss': float(miss_queries) / len(misses),
+    }
+
+
+@transaction.commit_on_success
+def delete_redirects(where=None, params=()):
+    """
+    Deletes generated redirects with a single statement.  The ORM would load
+    every row and send its delete signals.
+    """
+    sql = "DELETE FROM %s" % connection.ops.quote_name(CMSRedirect._meta.db_table)
+    if where:
+        sql += " WHERE " + where
+    connection.cursor().execute(sql, params)
+    transaction.set_dirty()
+    cache.bump_version()
+
+
+def benchmark_import(site, size, bulk):
+    fd, csv_path = tempfile.mkstemp(suffix='.csv')
+    csv_file = os.fdopen(fd, 'wb')
+    writer = csv.writer(csv_file)
+    writer.writerow(['Old Url', 'New Url', 'Response Code'])
+    for i in range(size):
+        writer.writerow(['/imported/%d/' % i, '/new/%d/' % i, '301'])
+    csv_file.close()
+
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    reset_queries()
+    start = time.time()
+    try:
+        call_command('import_redirect_csv', csv_path, site=site, bulk=bulk)
+    finally:
+        sys.stdout = stdout
+        os.remove(csv_path)
+    elapsed = time.time() - start
+    num_queries = len(connection.queries)
+    delete_redirects("old_path LIKE %s", ['/imported/%'])
+    return {
+        'benchmark': 'import',
+        'mode': bulk and 'bulk' or 'rows',
+        'rows': size,
+        'seconds': elapsed,
+        'rows_per_sec': size / max(elapsed, 0.001),
+        'queries_per_row': float(num_queries) / size,
+    }
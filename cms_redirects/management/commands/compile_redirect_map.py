@@ -0,0 +1,32 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from cms_redirects.redirect_map import compile_map
+
+class Command(BaseCommand):
+    can_import_settings = True
+    help='''
+    
+    Compiles the exact redirects of every site into a read-only map file that
+    the middleware memory-maps, so worker processes share one copy.  Writes
+    to settings.REDIRECT_MAP_PATH unless a path is given.
+    
+    Usage:
+    ./manage.py compile_redirect_map
+    ./manage.py compile_redirect_map /var/cache/redirects.map
+    
+    '''
+    args = "[map_path]"
+    
+    def execute(self, *args, **options):
+        if args:
+            path = args[0]
+        else:
+            path = getattr(settings, 'REDIRECT_MAP_PATH', None)
+        if not path:
+            raise CommandError("Must pass in a path or set REDIRECT_MAP_PATH")
+        start = time.time()
+        count = compile_map(path)
+        print "Wrote %d redirects to %s in %.1fs" % (count, path, time.time() - start)
@@ -0,0 +1,66 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.sites.models import Site
+
+from cms_redirects.server_maps import FORMATS, export_server_map
+
+class Command(BaseCommand):
+    can_import_settings = True
+    help='''
+
+    Writes the exact redirects of a site to a file nginx or Apache can serve
+    them from, so requests for legacy urls never reach Django.  Nothing is
+    rewritten when the redirects haven't changed since the last export.
+
+    Usage:
+    ./manage.py export_server_map /etc/nginx/redirects.map
+    ./manage.py export_server_map --site=example.com --format=apache /etc/apache2/redirects.txt
+    ./manage.py export_server_map --format=apache-dbm /etc/apache2/redirects.dbm
+
+    '''
+    args = "<map_path>"
+    option_list = BaseCommand.option_list + (
+            make_option('--site',
+                dest="site",
+                default=None,
+                help="Domain of the site to export redirects for.  Defaults to current site."),
+            make_option('--format',
+                dest="format",
+                default="nginx",
+                help="One of %s.  Defaults to nginx" % ", ".join(FORMATS)),
+            make_option('--force',
+                action='store_true',
+                dest="force",
+                default=False,
+                help="Rewrite the file even if nothing has changed"),
+            make_option('--chunk-size',
+                dest="chunk_size",
+                default=1000,
+                help="Number of redirects fetched per query"),
+            )
+
+    def execute(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Must pass in the path of the map to write")
+        if options["format"] not in FORMATS:
+            raise CommandError("Unknown format: %s" % options["format"])
+        if options["site"]:
+            try:
+                site = Site.objects.get(domain=options["site"])
+            except Site.DoesNotExist:
+                raise CommandError("No site found, invalid domain: %s" % options["site"])
+        else:
+            site = Site.objects.get_current()
+
+        start = time.time()
+        try:
+            count = export_server_map(site.pk, args[0], format=options["format"],
+                                      force=options["force"], chunk_size=int(options["chunk_size"]))
+        except ValueError, e:
+            raise CommandError(str(e))
+        if count is None:
+            print "%s is up to date" % args[0]
+        else:
+            print "Wrote %d redirects to %s in %.1fs" % (count, args[0], time.time() - start)
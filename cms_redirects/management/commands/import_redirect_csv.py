@@ -1,12 +1,32 @@
 import os
 import csv
+import time
 from optparse import make_option
 
 from django.core.management.base import BaseCommand, CommandError
 from django.contrib.sites.models import Site
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection, transaction
+from django.db.models.signals import post_save
+from django.utils.encoding import smart_unicode
 
 from cms_redirects.models import CMSRedirect
+from cms_redirects import cache, change_log, http_cache, redirect_map
+from cms_redirects.chains import RedirectLoop, flatten_site
+from cms_redirects.import_check import check_import
+from cms_redirects.matching import check_rule
+from cms_redirects.normalization import normalize
+
+HEADER_ROW = ["Old Url","New Url","Response Code"]
+OPTIONAL_COLUMNS = ["Site","Match Type"]
+MATCH_TYPES = ('exact', 'prefix', 'regex')
+
+# Keep lookups of existing redirects well under SQLite's limit of 999 query
+# parameters, whatever the chunk size.
+LOOKUP_BATCH_SIZE = 500
+
+# Number of rows listed under each heading of a dry run report.
+REPORT_LIMIT = 20
 
 class Command(BaseCommand):
     can_import_settings = True
@@ -16,8 +36,26 @@ class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
             make_option('--site',
                 dest="site",
-                default=Site.objects.get_current(),
+                default=None,
                 help="Use to specify the domain of the site you are importing redirects into.  Defaults to current site."),
+            make_option('--bulk',
+                action='store_true',
+                dest="bulk",
+                default=False,
+                help="Import in batches inside a single transaction instead of saving each row."),
+            make_option('--chunk-size',
+                dest="chunk_size",
+                default=1000,
+                help="Number of rows per batch when using --bulk.  Defaults to 1000."),
+            make_option('--dry-run',
+                action='store_true',
+                dest="dry_run",
+                default=False,
+                help="Report what the import would change and any problems with the file without importing it."),
+            make_option('--processes',
+                dest="processes",
+                default=None,
+                help="Number of processes validating rows of large files in a dry run.  Defaults to the number of CPUs."),
             )
     
     def execute(self, *args, **options):
@@ -30,33 +68,228 @@ class Command(BaseCommand):
         csv_file = open(csv_path, "rb")
         reader = csv.reader(csv_file)
         header_row = reader.next()
-        if header_row != ["Old Url","New Url","Response Code"]:
-            raise CommandError("CSV file is missing the correct header row.  Should be Old Url, New Url and Response Code")
+        extra_columns = header_row[len(HEADER_ROW):]
+        if (header_row[:len(HEADER_ROW)] != HEADER_ROW or len(set(extra_columns)) != len(extra_columns)
+                or not set(extra_columns) <= set(OPTIONAL_COLUMNS)):
+            raise CommandError("CSV file is missing the correct header row.  Should be Old Url, New Url and Response Code, optionally followed by Site and Match Type")
         reader = csv.DictReader(csv_file, header_row)
             
         current_site = options["site"]
-        if not isinstance(current_site, Site):
-            try:
-                current_site = Site.objects.get(domain=options["site"])
-            except ObjectDoesNotExist:
-                raise CommandError("No site found, invalid domain: %s" % options["site"])
-                
+        if current_site is None:
+            current_site = Site.objects.get_current()
+        elif not isinstance(current_site, Site):
+            current_site = get_site(current_site)
+        sites = SiteLookup(current_site)
+
+        if options["dry_run"]:
+            processes = options["processes"] and int(options["processes"]) or None
+            return self.dry_run(reader, sites, processes)
+        if options["bulk"]:
+            self.bulk_import(reader, sites, int(options["chunk_size"]))
+        else:
+            flattened = import_rows(reader, sites)
+            # Processes may have reloaded while the import's transaction was
+            # open, after the save signals had already invalidated them.
+            cache.bump_version()
+            http_cache.purge_all(CMSRedirect)
+            if flattened:
+                print "Flattened %d redirect chains" % flattened
+        redirect_map.rebuild()
+
+    def bulk_import(self, reader, sites, chunk_size):
+        start = time.time()
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        changed = []
+        flattened = import_chunks(reader, sites, chunk_size, counts, changed)
+        if flattened:
+            cache.bump_version()
+        else:
+            cache.redirects_changed(changed)
+        http_cache.purge_all(CMSRedirect)
+        elapsed = time.time() - start
+        total = sum(counts.values())
+        print "Inserted %(inserted)d, updated %(updated)d, unchanged %(unchanged)d redirects" % counts
+        print "Flattened %d redirect chains" % flattened
+        print "%d rows in %.1fs (%.0f rows/s)" % (total, elapsed, total / max(elapsed, 0.001))
+
+    def dry_run(self, reader, sites, processes):
+        start = time.time()
+        rows = []
+        for row in reader:
+            site = sites(row.get("Site"))
+            # The header row was read separately, so line_num starts one short.
+            rows.append((reader.line_num + 1, site.pk, smart_unicode(row["Old Url"]),
+                         smart_unicode(row["New Url"]), row["Response Code"], row.get("Match Type") or ''))
+        report = check_import(rows, processes)
+
+        domains = dict((site.pk, site.domain) for site in sites.sites.values())
+        print_section("Would add %d redirects" % len(report.added),
+                      ["line %d: %s -> %s" % row for row in report.added])
+        print_section("Would change %d redirects" % len(report.changed),
+                      ["line %d: %s from %s to %s" % row for row in report.changed])
+        print "%d redirects are unchanged" % report.unchanged
+        print "%d existing redirects are not in the file and would be kept" % report.not_in_file
+        print_section("%d duplicate sources, the last row wins" % len(report.duplicates),
+                      ["line %d repeats line %d: %s" % row for row in report.duplicates])
+        print_section("%d invalid rows" % len(report.invalid),
+                      ["line %d: %s" % row for row in report.invalid])
+        print "%d redirect chains would be flattened" % report.chains
+        print_section("%d redirect loops" % len(report.loops),
+                      ["%s: %s" % (domains[site_id], " -> ".join(paths + paths[:1])) for site_id, paths in report.loops])
+        print "Checked %d rows in %.1fs" % (len(rows), time.time() - start)
+
+
+def print_section(heading, lines):
+    print heading
+    for line in lines[:REPORT_LIMIT]:
+        print "    %s" % line.encode('utf-8')
+    if len(lines) > REPORT_LIMIT:
+        print "    ... and %d more" % (len(lines) - REPORT_LIMIT)
+
+
+def get_site(domain):
+    try:
+        return Site.objects.get(domain=domain)
+    except ObjectDoesNotExist:
+        raise CommandError("No site found, invalid domain: %s" % domain)
+
+
+class SiteLookup(object):
+    """
+    Resolves the optional Site column of each row, falling back to the site
+    given on the command line.
+    """
+    def __init__(self, default):
+        self.default = default
+        self.sites = {default.domain: default}
+
+    def __call__(self, domain):
+        if not domain:
+            return self.default
+        if domain not in self.sites:
+            self.sites[domain] = get_site(domain)
+        return self.sites[domain]
+
+
+def clean_row(row, sites):
+    resp_code = row["Response Code"]
+    if resp_code not in ['301', '302']:
+        resp_code = '301'
+    match_type = row.get("Match Type") or 'exact'
+    if match_type not in MATCH_TYPES:
+        raise CommandError("Unknown match type %r for %s" % (match_type, row["Old Url"]))
+    old_url, new_url = smart_unicode(row["Old Url"]), smart_unicode(row["New Url"])
+    problem = check_rule(match_type, old_url, new_url)
+    if problem:
+        raise CommandError("Invalid %s rule %s: %s" % (match_type, old_url, problem))
+    site = sites(row.get("Site"))
+    return site, old_url, new_url, resp_code, match_type
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def flatten_sites(sites):
+    """
+    Flattens redirect chains on every site imported into, returning the
+    number of redirects changed.
+    """
+    flattened = 0
+    for site in sites.sites.values():
+        try:
+            flattened += flatten_site(site.pk)
+        except RedirectLoop as e:
+            raise CommandError("Import would create a redirect loop on %s: %s" % (site.domain, e))
+    return flattened
+
+
+@transaction.commit_on_success
+def import_rows(reader, sites):
+    """
+    Saves the rows from reader one at a time, in a single transaction so a
+    redirect loop rolls back the whole import.  Responses are not purged per
+    row; the caller purges them all once the import has committed.
+    """
+    post_save.disconnect(http_cache.redirect_changed, sender=CMSRedirect)
+    try:
         for row in reader:
-            old_url = row["Old Url"]
-            new_url = row["New Url"]
-            resp_code = row["Response Code"]
-            if resp_code not in ['301', '302']:
-                resp_code = '301'
-            redirect, created = CMSRedirect.objects.get_or_create(site=current_site, old_path=old_url)
+            site, old_url, new_url, resp_code, match_type = clean_row(row, sites)
+            redirect, created = CMSRedirect.objects.get_or_create(site=site, old_path=old_url)
             redirect.new_path = new_url
             redirect.response_code = resp_code
+            redirect.match_type = match_type
             redirect.save()
-            
-        
-        
-        
-            
-            
-          
-          
-        
+    finally:
+        post_save.connect(http_cache.redirect_changed, sender=CMSRedirect)
+    return flatten_sites(sites)
+
+
+def find_existing(rows):
+    """
+    Returns (pk, site_id, old_path, new_path, response_code, match_type) for the
+    redirects already stored under the (site_id, old_url) keys of rows.
+    """
+    by_site = {}
+    for site_id, old_url in rows:
+        by_site.setdefault(site_id, []).append(old_url)
+    existing = []
+    for site_id, old_urls in by_site.items():
+        for i in range(0, len(old_urls), LOOKUP_BATCH_SIZE):
+            existing.extend(CMSRedirect.objects.filter(site__id__exact=site_id,
+                                                       old_path__in=old_urls[i:i + LOOKUP_BATCH_SIZE])
+                            .values_list('pk', 'site', 'old_path', 'new_path', 'response_code', 'match_type'))
+    return existing
+
+
+@transaction.commit_on_success
+def import_chunks(reader, sites, chunk_size, counts, changed):
+    """
+    Imports the rows from reader in a single transaction, one insert and one
+    update batch per chunk, then flattens redirect chains.  Later rows win
+    over earlier rows for the same site and old url.  CMSRedirect signals are
+    not sent; the paths inserted or updated are added to changed for the
+    change log, until there are more than it takes.
+    """
+    table = connection.ops.quote_name(CMSRedirect._meta.db_table)
+    insert_sql = ("INSERT INTO %s (site_id, old_path, normalized_path, match_type, new_path, response_code, early, hits) "
+                  "VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, 0)" % table)
+    update_sql = "UPDATE %s SET new_path = %%s, response_code = %%s, match_type = %%s WHERE id = %%s" % table
+    cursor = connection.cursor()
+    for chunk in chunked(reader, chunk_size):
+        rows = {}
+        for row in chunk:
+            site, old_url, new_url, resp_code, match_type = clean_row(row, sites)
+            rows[(site.pk, old_url)] = (new_url, resp_code, match_type)
+
+        inserts, updates = [], []
+        for pk, site_id, old_url, new_url, resp_code, match_type in find_existing(rows):
+            row = rows.pop((site_id, old_url), None)
+            if row is None:
+                continue
+            if row == (new_url, resp_code, match_type):
+                counts['unchanged'] += 1
+            else:
+                updates.append((row[0], row[1], row[2], pk))
+                if len(changed) <= change_log.get_size():
+                    changed.append((site_id, old_url, normalize(old_url)))
+        for (site_id, old_url), (new_url, resp_code, match_type) in rows.items():
+            inserts.append((site_id, old_url, normalize(old_url), match_type, new_url, resp_code, False))
+            if len(changed) <= change_log.get_size():
+                changed.append((site_id, old_url, normalize(old_url)))
+
+        if inserts:
+            cursor.executemany(insert_sql, inserts)
+        if updates:
+            cursor.executemany(update_sql, updates)
+        transaction.set_dirty()
+        counts['inserted'] += len(inserts)
+        counts['updated'] += len(updates)
+    return flatten_sites(sites)
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from cms_redirects import cache, redirect_map
+from cms_redirects.models import CMSRedirect
+from cms_redirects.normalization import normalize
+
+class Command(BaseCommand):
+    can_import_settings = True
+    help='''
+    
+    Recomputes the normalized lookup key of every redirect.  Run this after
+    changing any of the REDIRECT_NORMALIZE_* settings.
+    
+    Usage:
+    ./manage.py normalize_redirect_paths
+    
+    '''
+    
+    def execute(self, *args, **options):
+        updated = normalize_all()
+        cache.bump_version()
+        redirect_map.rebuild()
+        print "Updated %d redirects" % updated
+
+
+@transaction.commit_on_success
+def normalize_all():
+    updated = 0
+    rows = CMSRedirect.objects.values_list('pk', 'old_path', 'normalized_path').order_by('pk')
+    for pk, old_path, normalized_path in rows.iterator():
+        if normalize(old_path) != normalized_path:
+            CMSRedirect.objects.filter(pk=pk).update(normalized_path=normalize(old_path))
+            updated += 1
+    return updated
@@ -2,12 +2,17 @@ import StringIO
 import csv
 import datetime
 import operator
+import os
+import sys
 
 from django.core.management.base import BaseCommand, CommandError
 from django.contrib.sites.models import Site
 from django.conf import settings
 from django.utils import simplejson
 
+from cms_redirects.models import CMSRedirect
+from cms_redirects import access_logs, cache
+
 from optparse import make_option
 
 class Command(BaseCommand):
@@ -17,13 +22,23 @@ class Command(BaseCommand):
     Sends to stdout a csv file that can be used to import redirects.
     
     Optionally, you can specify google analytics account information to
-    prepopulate the csv file.
+    prepopulate the csv file, or prepopulate it offline from web server
+    access logs in the combined format, plain or gzipped.
+    
+    With --export, streams the existing redirects instead, in a format that
+    can be passed back to import_redirect_csv.  Page redirects are written
+    with the page's current url as their destination, and a Match Type
+    column is added if there are prefix or regex rules.
     
     Usage:
     ./manage.py redirect_csv > import.csv
     ./manage.py redirect_csv --ga > import_google_analytics.csv
+    ./manage.py redirect_csv --logs /var/log/nginx/access.log* > import_logs.csv
+    ./manage.py redirect_csv --export --site=example.com > redirects.csv
+    ./manage.py redirect_csv --export --all-sites --output=redirects.csv
     
     '''
+    args = "[log_path ...]"
     option_list = BaseCommand.option_list + (
             make_option('--ga',
                 action='store_true',
@@ -46,10 +61,51 @@ class Command(BaseCommand):
                 dest="num_analytics_months",
                 default=6,
                 help="Number of months to pull google analytics data for"),
+            make_option('--logs',
+                action='store_true',
+                dest="use_logs",
+                default=False,
+                help="Use the access logs given as arguments to prepopulate the csv"),
+            make_option('--log-statuses',
+                dest="log_statuses",
+                default="404",
+                help="Comma separated response codes of the requests to count.  Defaults to 404"),
+            make_option('--top',
+                dest="top",
+                default=10000,
+                help="Number of most requested paths to write when using --logs.  Defaults to 10000"),
+            make_option('--processes',
+                dest="processes",
+                default=None,
+                help="Number of processes reading logs.  Defaults to the number of CPUs"),
+            make_option('--export',
+                action='store_true',
+                dest="export",
+                default=False,
+                help="Export the existing redirects instead of a template"),
+            make_option('--site',
+                dest="site",
+                default=None,
+                help="Domain of the site to export redirects for.  Defaults to current site."),
+            make_option('--all-sites',
+                action='store_true',
+                dest="all_sites",
+                default=False,
+                help="Export redirects for every site, adding a Site column"),
+            make_option('--output',
+                dest="output",
+                default=None,
+                help="File to write the export to.  Defaults to stdout."),
+            make_option('--chunk-size',
+                dest="chunk_size",
+                default=1000,
+                help="Number of redirects fetched per query when exporting"),
             )
     
     
     def execute(self, *args, **options):
+        if options["export"]:
+            return self.export(**options)
         output = StringIO.StringIO()
         writer = csv.writer(output)
         writer.writerow(['Old Url','New Url','Response Code'])
@@ -70,8 +126,72 @@ class Command(BaseCommand):
             sorted_data = sorted(data.dict.iteritems(), key=operator.itemgetter(1), reverse=True)
             for url, visits in sorted_data:
                 writer.writerow([csv_safe(url),'',''])
+        if options["use_logs"]:
+            if not args:
+                raise CommandError('Must pass in the paths of the access logs')
+            for path in args:
+                if not os.path.exists(path):
+                    raise CommandError("File not found, invalid path: %s" % path)
+            processes = options["processes"] and int(options["processes"]) or None
+            statuses = options["log_statuses"].split(",")
+            for url, hits in access_logs.count_paths(args, statuses, int(options["top"]), processes):
+                writer.writerow([url,'',''])
                 
         print output.getvalue()
+
+    def export(self, **options):
+        redirects = CMSRedirect.objects.all()
+        header_row = ['Old Url','New Url','Response Code']
+        if options["all_sites"]:
+            header_row.append('Site')
+        elif options["site"]:
+            try:
+                redirects = redirects.filter(site=Site.objects.get(domain=options["site"]))
+            except Site.DoesNotExist:
+                raise CommandError("No site found, invalid domain: %s" % options["site"])
+        else:
+            redirects = redirects.filter(site=Site.objects.get_current())
+        match_types = redirects.exclude(match_type='exact').exists()
+        if match_types:
+            header_row.append('Match Type')
+
+        if options["output"]:
+            output = open(options["output"], "wb")
+        else:
+            output = sys.stdout
+        writer = csv.writer(output)
+        writer.writerow(header_row)
+        for r in iter_chunked(redirects.select_related('site'), int(options["chunk_size"])):
+            if r.page_id:
+                new_path = cache.get_page_url(r.page_id)
+            else:
+                new_path = r.new_path
+            row = [csv_safe(r.old_path), csv_safe(new_path), r.response_code]
+            if options["all_sites"]:
+                row.append(csv_safe(r.site.domain))
+            if match_types:
+                row.append(r.match_type)
+            writer.writerow(row)
+        if options["output"]:
+            output.close()
+
+
+def iter_chunked(queryset, chunk_size):
+    """
+    Yields every object in queryset, fetching chunk_size rows at a time
+    ordered by primary key so memory use stays flat on large tables.
+    """
+    last_pk = None
+    while True:
+        chunk = queryset.order_by('pk')
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+        for obj in chunk:
+            yield obj
+        last_pk = chunk[-1].pk
         
 def csv_safe(s):
     if isinstance(s,basestring):
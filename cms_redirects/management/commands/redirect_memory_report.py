@@ -0,0 +1,76 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.sites.models import Site
+
+from cms_redirects import cache, normalization
+from cms_redirects.models import CMSRedirect
+
+# Number of redirects loaded as model instances for comparison.
+SAMPLE_SIZE = 1000
+
+class Command(BaseCommand):
+    can_import_settings = True
+    help='''
+
+    Loads each site's local redirect table, as REDIRECT_LOCAL_CACHE would,
+    and prints the memory it takes up and the bytes per redirect, with the
+    bytes per redirect of a sample held as model instances for comparison.
+    Use it to size workers for large redirect tables.
+
+    Usage:
+    ./manage.py redirect_memory_report
+    ./manage.py redirect_memory_report --site=example.com
+
+    '''
+    option_list = BaseCommand.option_list + (
+            make_option('--site',
+                dest="site",
+                default=None,
+                help="Domain of the site to report on.  Defaults to every site with redirects."),
+            )
+
+    def execute(self, *args, **options):
+        if options["site"]:
+            try:
+                site_ids = [Site.objects.get(domain=options["site"]).pk]
+            except Site.DoesNotExist:
+                raise CommandError("No site found, invalid domain: %s" % options["site"])
+        else:
+            site_ids = CMSRedirect.objects.order_by().values_list('site', flat=True).distinct()
+        key = normalization.is_enabled() and 'normalized_path' or 'old_path'
+
+        for site in Site.objects.filter(pk__in=list(site_ids)).order_by('domain'):
+            table = cache.load_table(site.pk, key=key)
+            size = table_size(table)
+            print "%s: %d redirects, %.1f MB, %d bytes per redirect" % (
+                site.domain, len(table), size / 1048576.0, size / max(len(table), 1))
+            sample = list(CMSRedirect.objects.filter(site=site, match_type='exact')[:SAMPLE_SIZE])
+            if sample:
+                print "    as model instances: %d bytes per redirect" % (
+                    table_size(dict((getattr(r, key), r) for r in sample)) / len(sample))
+
+
+def table_size(table):
+    """
+    Returns the approximate bytes taken up by a redirect table: the dict,
+    its keys and values and every distinct object the values refer to.
+    """
+    seen = set()
+    total = sys.getsizeof(table)
+    def add(obj):
+        if id(obj) not in seen:
+            seen.add(id(obj))
+            return sys.getsizeof(obj)
+        return 0
+    for key, r in table.items():
+        total += add(key) + add(r)
+        if hasattr(r, '__dict__'):
+            total += add(r.__dict__)
+            fields = r.__dict__.values()
+        else:
+            fields = [getattr(r, name) for name in r.__slots__]
+        for value in fields:
+            total += add(value)
+    return total
@@ -0,0 +1,48 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.sites.models import Site
+
+from cms_redirects.warmup import warm
+
+class Command(BaseCommand):
+    can_import_settings = True
+    help='''
+
+    Loads redirects, pattern rules and the urls of redirected pages, so the
+    page urls kept in Django's cache are resolved before traffic arrives and
+    the time taken to warm a process can be measured.
+
+    Usage:
+    ./manage.py warm_redirects
+    ./manage.py warm_redirects --site=example.com --languages=en,de
+
+    '''
+    option_list = BaseCommand.option_list + (
+            make_option('--site',
+                dest="site",
+                default=None,
+                help="Domain of the site to warm.  Defaults to every site with redirects."),
+            make_option('--languages',
+                dest="languages",
+                default=None,
+                help="Comma separated languages to resolve page urls in.  Defaults to settings.LANGUAGES."),
+            )
+
+    def execute(self, *args, **options):
+        site_ids = None
+        if options["site"]:
+            try:
+                site_ids = [Site.objects.get(domain=options["site"]).pk]
+            except Site.DoesNotExist:
+                raise CommandError("No site found, invalid domain: %s" % options["site"])
+        languages = None
+        if options["languages"]:
+            languages = options["languages"].split(",")
+
+        start = time.time()
+        counts = warm(site_ids, languages)
+        counts['elapsed'] = time.time() - start
+        print ("Loaded %(redirects)d redirects on %(sites)d sites and %(pages)d page urls "
+               "in %(languages)d languages in %(elapsed).1fs" % counts)
@@ -0,0 +1,167 @@
+"""
+Matching of prefix and regex redirect rules.
+
+All prefix rules for a site are held in a character trie, so finding the
+longest matching prefix costs one step per character of the path no matter
+how many rules there are.  Regex rules are combined into a single alternation
+so a path is scanned once; the rule's own pattern is then used to fill its
+capture groups into ``new_path``.  ``check_rule`` refuses the regex features
+that would change meaning once combined: inline flags, which apply to the
+whole pattern, and backreferences, whose group numbers shift.
+"""
+import copy
+import logging
+import re
+import sre_constants
+import sre_parse
+
+NAMED_GROUP_RE = re.compile(r'\(\?P<[^>]+>')
+
+logger = logging.getLogger('cms_redirects')
+
+
+def iter_subpatterns(value):
+    if isinstance(value, sre_parse.SubPattern):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            for subpattern in iter_subpatterns(item):
+                yield subpattern
+
+
+def has_backreference(parsed):
+    for op, av in parsed:
+        if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+            return True
+        for subpattern in iter_subpatterns(av):
+            if has_backreference(subpattern):
+                return True
+    return False
+
+
+def can_combine(old_path):
+    """
+    Returns whether a valid regex can be part of the combined pattern.
+    """
+    parsed = sre_parse.parse(old_path)
+    return not parsed.pattern.flags and not has_backreference(parsed)
+
+
+def rule_pattern(match_type, old_path):
+    if match_type == 'prefix':
+        return re.compile(re.escape(old_path) + '(.*)', re.S)
+    return re.compile(old_path)
+
+
+def check_rule(match_type, old_path, new_path):
+    """
+    Returns why a prefix or regex rule can't be used, or None if it can.
+    """
+    if match_type not in ('prefix', 'regex'):
+        return None
+    try:
+        pattern = rule_pattern(match_type, old_path)
+    except re.error as e:
+        return "invalid regular expression: %s" % e
+    if match_type == 'regex' and not can_combine(old_path):
+        return "inline flags such as (?i) and backreferences are not supported"
+    if new_path:
+        try:
+            groups = sre_parse.parse_template(new_path, pattern)[0]
+        except (re.error, IndexError) as e:
+            return "invalid group reference in new path: %s" % e
+        for position, index in groups:
+            if index > pattern.groups:
+                return "new path refers to group %d, which the pattern doesn't have" % index
+    return None
+
+
+class PatternMatcher(object):
+    def __init__(self, rules):
+        self.trie = {}
+        self.regex_rules = []
+        for rule in rules:
+            if rule.match_type == 'prefix':
+                self.add_prefix(rule)
+            elif rule.match_type == 'regex':
+                try:
+                    self.regex_rules.append((re.compile(rule.old_path), rule))
+                except re.error:
+                    continue
+        self.combined = self.combine()
+
+    def add_prefix(self, rule):
+        node = self.trie
+        for char in rule.old_path:
+            node = node.setdefault(char, {})
+        node[None] = (rule_pattern('prefix', rule.old_path), rule)
+
+    def combine(self):
+        """
+        Returns one regex matching any of the rules, with each rule wrapped in
+        an outer group so ``lastindex`` tells which one matched, or None if
+        the patterns can't be combined (e.g. rules saved before inline flags
+        and backreferences were refused).
+        """
+        self.group_rules = {}
+        if not self.regex_rules:
+            return None
+        if not all(can_combine(rule.old_path) for pattern, rule in self.regex_rules):
+            return None
+        parts = []
+        index = 1
+        for pattern, rule in self.regex_rules:
+            self.group_rules[index] = (pattern, rule)
+            parts.append('(%s)' % NAMED_GROUP_RE.sub('(', rule.old_path))
+            index += pattern.groups + 1
+        try:
+            return re.compile('|'.join(parts))
+        except re.error:
+            return None
+
+    def match_prefix(self, path):
+        node = self.trie
+        found = node.get(None)
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                found = node[None]
+        return found
+
+    def match_regex(self, path):
+        if self.combined is not None:
+            m = self.combined.match(path)
+            if m is not None:
+                return self.group_rules[m.lastindex]
+            return None
+        for pattern, rule in self.regex_rules:
+            if pattern.match(path):
+                return pattern, rule
+        return None
+
+    def match(self, path):
+        """
+        Returns a copy of the longest matching prefix rule, or else the first
+        matching regex rule, with its capture groups substituted into
+        ``new_path``.  Returns None if no rule matches.  A rule whose groups
+        can't be substituted is logged and skipped.
+        """
+        for find in (self.match_prefix, self.match_regex):
+            found = find(path)
+            if found is None:
+                continue
+            pattern, rule = found
+            r = copy.copy(rule)
+            if r.new_path:
+                m = pattern.match(path)
+                try:
+                    if m is None:
+                        raise re.error("pattern does not match the path on its own")
+                    r.new_path = m.expand(r.new_path)
+                except (re.error, IndexError) as e:
+                    logger.warning("skipping redirect rule %s for %s: %s", rule.pk, path, e)
+                    continue
+            return r
+        return None
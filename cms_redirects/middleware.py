@@ -1,12 +1,36 @@
+import logging
+import time
+
 from cms_redirects.models import CMSRedirect
+from cms_redirects import cache
+from cms_redirects import hits
+from cms_redirects import http_cache
+from cms_redirects import instrumentation
+from cms_redirects import normalization
+from cms_redirects import not_found
+from cms_redirects import redirect_map
+from cms_redirects import warmup
+from cms_redirects.signals import redirect_lookup
 from django import http
 from django.conf import settings
 
+logger = logging.getLogger('cms_redirects')
+
 
-def get_redirect(old_path):
+def get_redirect(old_path, site_id=None):
+    """
+    Returns the exact redirect stored under old_path, or None.  This is a
+    CMSRedirect unless REDIRECT_LOCAL_CACHE is set, in which case it is a
+    cache.CompactRedirect; both have pk, page_id, new_path, response_code
+    and cache_max_age, which is all build_response needs.
+    """
+    if site_id is None:
+        site_id = settings.SITE_ID
+    if cache.is_enabled():
+        return cache.get_redirect(site_id, old_path)
     try:
-        r = CMSRedirect.objects.get(site__id__exact=settings.SITE_ID,
-                                    old_path=old_path)
+        r = CMSRedirect.objects.get(site__id__exact=site_id,
+                                    old_path=old_path, match_type='exact')
     except CMSRedirect.DoesNotExist:
         r = None
     return r
@@ -20,38 +44,178 @@ def remove_query(path):
     return path.split('?', 1)[0]
 
 
-class RedirectFallbackMiddleware(object):
-    def process_exception(self, request, exception):
-        if isinstance(exception, http.Http404):
+def get_candidate_paths(path):
+    """
+    Returns (strategy, path) pairs for the paths a redirect may be stored
+    under, in order of precedence.  With normalization enabled these are
+    normalized keys instead.
+    """
+    if normalization.is_enabled():
+        return normalization.get_candidate_keys(path)
+
+    # First try the whole path.
+    candidates = [(instrumentation.EXACT, path)]
+
+    # It could be that we need to try without a trailing slash.
+    if settings.APPEND_SLASH:
+        candidates.append((instrumentation.NO_SLASH, remove_slash(path)))
+
+    if path.count('?'):
+        # It could be that the redirect is defined without a query string.
+        candidates.append((instrumentation.NO_QUERY, remove_query(path)))
+
+        # It could be that we need to try without query string and without a trailing slash.
+        if settings.APPEND_SLASH:
+            candidates.append((instrumentation.NO_SLASH_NO_QUERY, remove_slash(remove_query(path))))
+
+    return candidates
+
+
+def get_site_id(request):
+    """
+    Returns the id of the site a request is for: the one matching its host
+    with ``REDIRECT_SITE_BY_HOST``, otherwise settings.SITE_ID.
+    """
+    if cache.site_by_host_enabled():
+        return cache.get_site_id(request.get_host())
+    return settings.SITE_ID
+
+
+def lookup(path, site_id):
+    """
+    Returns the redirect matching path on a site, the strategy that matched
+    it and where the answer came from.
+    """
+    candidates = get_candidate_paths(path)
+    table = None
+    if redirect_map.is_enabled():
+        table = redirect_map.get_table(site_id)
+        outcome = 'map'
+    if table is not None:
+        pass
+    elif cache.is_enabled():
+        table = cache.get_table(site_id)
+        outcome = 'local'
+    elif cache.negative_cache_enabled() and cache.is_known_miss(site_id, path):
+        return None, None, 'negative'
+    else:
+        instrumentation.count_query()
+        redirects = CMSRedirect.objects.filter(site__id__exact=site_id, match_type='exact')
+        keys = [c[1] for c in candidates]
+        if normalization.is_enabled():
+            # Where several redirects share a normalized key the oldest one wins.
+            table = dict((r.normalized_path, r) for r in
+                         redirects.filter(normalized_path__in=keys).order_by('-pk'))
+        else:
+            table = dict((r.old_path, r) for r in redirects.filter(old_path__in=keys))
+        outcome = 'db'
+    for strategy, candidate in candidates:
+        r = table.get(candidate)
+        if r is not None:
+            return r, strategy, outcome
+    r = cache.get_matcher(site_id).match(path)
+    if r is not None:
+        return r, instrumentation.PATTERN, outcome
+    if outcome == 'db' and cache.negative_cache_enabled():
+        cache.remember_miss(site_id, path)
+    return None, None, outcome
+
+
+def find_redirect(path, site_id=None):
+    """
+    Returns the redirect matching path or one of its fallback variants,
+    resolving all of them with a single query.  If no exact redirect
+    matches, the site's prefix and regex rules are tried.  Looks on the
+    site given by settings.SITE_ID unless site_id is passed.
+
+    Exact redirects served from REDIRECT_MAP_PATH or REDIRECT_LOCAL_CACHE
+    are cache.CompactRedirects rather than CMSRedirects.  Only rely on the
+    pk, page_id, new_path, response_code and cache_max_age of the result,
+    and fetch the model by pk where you need anything else.
+    """
+    if site_id is None:
+        site_id = settings.SITE_ID
+    if not instrumentation.is_enabled():
+        return lookup(path, site_id)[0]
+    start = time.time()
+    queries = instrumentation.query_count()
+    r, strategy, outcome = lookup(path, site_id)
+    redirect_lookup.send(sender=RedirectFallbackMiddleware, path=path, site_id=site_id,
+                         redirect=r, strategy=strategy, duration=time.time() - start,
+                         queries=instrumentation.query_count() - queries, cache=outcome)
+    return r
 
-            # First try the whole path.
-            path = request.get_full_path()
-            r = get_redirect(path)
 
-            # It could be that we need to try without a trailing slash.
-            if r is None and settings.APPEND_SLASH:
-                r = get_redirect(remove_slash(path))
+def build_response(r):
+    if hits.is_enabled():
+        hits.record_hit(r.pk)
+    if r.page_id:
+        if r.response_code == '302':
+            response = http.HttpResponseRedirect(cache.get_page_url(r.page_id))
+        else:
+            response = http.HttpResponsePermanentRedirect(cache.get_page_url(r.page_id))
+    elif r.new_path == '':
+        response = http.HttpResponseGone()
+    elif r.response_code == '302':
+        response = http.HttpResponseRedirect(r.new_path)
+    else:
+        response = http.HttpResponsePermanentRedirect(r.new_path)
+    return http_cache.patch_response(response, r)
 
-            # It could be that the redirect is defined without a query string.
-            if r is None and path.count('?'):
-                r = get_redirect(remove_query(path))
 
-            # It could be that we need to try without query string and without a trailing slash.
-            if r is None and path.count('?') and settings.APPEND_SLASH:
-                r = get_redirect(remove_slash(remove_query(path)))
+class RedirectFallbackMiddleware(object):
+    """
+    Works both as an old-style middleware in ``MIDDLEWARE_CLASSES`` and as a
+    new-style one in ``MIDDLEWARE``, where it is called with get_response and
+    Django still calls process_exception on it.  There is no native async
+    path, so under ASGI Django runs it in a thread; enable REDIRECT_MAP_PATH,
+    REDIRECT_LOCAL_CACHE or REDIRECT_EARLY to keep that thread off the
+    database.  With REDIRECT_WARM_ON_STARTUP it loads redirect data when
+    it is instantiated, which Django 1.2 only does on the first request;
+    call warmup.warm() from your WSGI script to load it before traffic.
+    """
+    sync_capable = True
+    async_capable = False
+
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+        if warmup.is_enabled():
+            try:
+                warmup.warm()
+            except Exception:
+                # Redirects still load on demand; don't fail the request.
+                logger.exception("redirect warmup failed")
+
+    def __call__(self, request):
+        response = self.process_request(request)
+        if response is None:
+            response = self.get_response(request)
+        return response
+
+    def process_request(self, request):
+        # Redirects marked as early are served from memory before the
+        # request reaches url resolution or the CMS.
+        if getattr(settings, 'REDIRECT_EARLY', False):
+            path = request.get_full_path()
+            start = time.time()
+            site_id = get_site_id(request)
+            r = cache.get_early_table(site_id).get(path)
+            if r is not None:
+                if instrumentation.is_enabled():
+                    redirect_lookup.send(sender=RedirectFallbackMiddleware, path=path, site_id=site_id,
+                                         redirect=r, strategy=instrumentation.EARLY, duration=time.time() - start,
+                                         queries=0, cache='local')
+                return build_response(r)
 
+    def process_exception(self, request, exception):
+        if isinstance(exception, http.Http404):
 
-            if r is not None:
-                if r.page:
-                    if r.response_code == '302':
-                        return http.HttpResponseRedirect(r.page.get_absolute_url())
-                    else:
-                        return http.HttpResponsePermanentRedirect(r.page.get_absolute_url())
-                if r.new_path == '':
-                    return http.HttpResponseGone()
-                if r.response_code == '302':
-                    return http.HttpResponseRedirect(r.new_path)
-                else:
-                    return http.HttpResponsePermanentRedirect(r.new_path)
+            site_id = get_site_id(request)
+            r = find_redirect(request.get_full_path(), site_id)
 
+            if r is not None:
+                return build_response(r)
 
+            if not_found.is_enabled():
+                not_found.record(site_id, request.get_full_path(),
+                                 request.META.get('HTTP_REFERER', ''))
@@ -1,24 +1,46 @@
 from django.db import models
+from django.core.exceptions import ValidationError
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.contrib.sites.models import Site
 from django.utils.translation import ugettext_lazy as _
 from cms.models.fields import PageField
 
-from cms.models import Page
+from cms.models import Page, Title
+from cms.signals import page_moved, post_publish
+
+from cms_redirects import cache, http_cache, instrumentation
+from cms_redirects.matching import check_rule
+from cms_redirects.normalization import normalize
 
 RESPONSE_CODES = (
     ('301', '301'),
     ('302', '302'),
 )
 
+MATCH_TYPES = (
+    ('exact', _('Exact path')),
+    ('prefix', _('Path prefix')),
+    ('regex', _('Regular expression')),
+)
+
 class CMSRedirect(models.Model):
     page = PageField(verbose_name=_("page"), blank=True, null=True, help_text=_("A link to a page has priority over a text link."))
     site = models.ForeignKey(Site)
     old_path = models.CharField(_('redirect from'), max_length=200, db_index=True,
         help_text=_("This should be an absolute path, excluding the domain name. Example: '/events/search/'."))
-    new_path = models.CharField(_('redirect to'), max_length=200, blank=True,
+    match_type = models.CharField(_('match type'), max_length=6, choices=MATCH_TYPES, default=MATCH_TYPES[0][0],
+        help_text=_("Exact paths always win. Otherwise the longest matching prefix is used, then the first matching regular expression. Groups captured by a regular expression, or the rest of the path after a prefix as \\1, can be used in the destination."))
+    new_path = models.CharField(_('redirect to'), max_length=200, blank=True, db_index=True,
         help_text=_("This can be either an absolute path (as above) or a full URL starting with 'http://'."))
     response_code = models.CharField(_('response code'), max_length=3, choices=RESPONSE_CODES, default=RESPONSE_CODES[0][0],
         help_text=_("This is the http response code returned if a destination is specified. If no destination is specified the response code will be 410."))
+    early = models.BooleanField(_('redirect before page lookup'), default=False,
+        help_text=_("Serve this redirect before the page is looked up. Useful for busy legacy urls; requires REDIRECT_EARLY."))
+    cache_max_age = models.PositiveIntegerField(_('cache for'), blank=True, null=True,
+        help_text=_("Seconds browsers and caching proxies may keep this response. Leave blank to use REDIRECT_CACHE_MAX_AGE."))
+    hits = models.PositiveIntegerField(_('hits'), default=0, editable=False)
+    last_hit = models.DateTimeField(_('last hit'), blank=True, null=True, editable=False)
+    normalized_path = models.CharField(max_length=200, db_index=True, editable=False)
     
     def page_site(self):
         if self.page:
@@ -32,6 +54,16 @@ class CMSRedirect(models.Model):
         return u'410'
     actual_response_code.short_description = "Response Code"
     
+    def save(self, *args, **kwargs):
+        self.normalized_path = normalize(self.old_path)
+        super(CMSRedirect, self).save(*args, **kwargs)
+
+    def clean(self):
+        problem = check_rule(self.match_type, self.old_path, self.new_path)
+        if problem:
+            raise ValidationError(_("Invalid %(match_type)s rule: %(problem)s") %
+                                  {'match_type': self.match_type, 'problem': problem})
+
     class Meta:
         verbose_name = _('CMS Redirect')
         verbose_name_plural = _('CMS Redirects')
@@ -40,3 +72,37 @@ class CMSRedirect(models.Model):
     
     def __unicode__(self):
         return "%s ---> %s" % (self.old_path, self.new_path)
+
+class MissingPath(models.Model):
+    site = models.ForeignKey(Site)
+    path = models.CharField(_('path'), max_length=200)
+    hits = models.PositiveIntegerField(_('hits'), default=0)
+    last_hit = models.DateTimeField(_('last hit'))
+    referrer = models.CharField(_('last referrer'), max_length=200, blank=True)
+
+    class Meta:
+        verbose_name = _('404 path')
+        verbose_name_plural = _('404 paths')
+        unique_together=(('site', 'path'),)
+        ordering = ('-hits',)
+
+    def __unicode__(self):
+        return self.path
+
+pre_save.connect(cache.remember_paths, sender=CMSRedirect)
+post_save.connect(cache.redirect_changed, sender=CMSRedirect)
+post_delete.connect(cache.redirect_changed, sender=CMSRedirect)
+post_save.connect(http_cache.redirect_changed, sender=CMSRedirect)
+post_delete.connect(http_cache.redirect_changed, sender=CMSRedirect)
+
+post_save.connect(cache.site_changed, sender=Site)
+post_delete.connect(cache.site_changed, sender=Site)
+
+post_save.connect(cache.page_changed, sender=Page)
+post_delete.connect(cache.page_changed, sender=Page)
+post_save.connect(cache.page_changed, sender=Title)
+post_delete.connect(cache.page_changed, sender=Title)
+page_moved.connect(cache.page_changed, sender=Page)
+post_publish.connect(cache.page_changed, sender=Page)
+
+instrumentation.connect_receivers()
@@ -0,0 +1,59 @@
+"""
+Normalized lookup keys.
+
+Every redirect stores a normalized form of its ``old_path`` in an indexed
+``normalized_path`` column.  With ``REDIRECT_NORMALIZE`` enabled the
+middleware normalizes the requested path the same way and resolves it with a
+single probe of that index, instead of trying string-mangled variants.
+
+``REDIRECT_NORMALIZE_CASE`` lower-cases the path, ``REDIRECT_NORMALIZE_SLASH``
+drops a trailing slash and ``REDIRECT_NORMALIZE_QUERY`` is one of 'keep',
+'sort' (order the query parameters) or 'strip' (drop the query string).
+After changing these settings run ``./manage.py normalize_redirect_paths``.
+"""
+from django.conf import settings
+
+from cms_redirects import instrumentation
+
+NORMALIZED = 'normalized'
+
+
+def is_enabled():
+    return getattr(settings, 'REDIRECT_NORMALIZE', False)
+
+
+def normalize(path):
+    path, sep, query = path.partition('?')
+    if getattr(settings, 'REDIRECT_NORMALIZE_CASE', True):
+        path = path.lower()
+    if getattr(settings, 'REDIRECT_NORMALIZE_SLASH', True) and len(path) > 1:
+        path = path.rstrip('/') or '/'
+    mode = getattr(settings, 'REDIRECT_NORMALIZE_QUERY', 'keep')
+    if mode == 'strip' or not query:
+        return path
+    if mode == 'sort':
+        query = '&'.join(sorted(query.split('&')))
+    return path + '?' + query
+
+
+def get_candidate_keys(path):
+    """
+    Returns (strategy, key) pairs to look up in ``normalized_path``, in order
+    of precedence.  A redirect defined without a query string still matches
+    a request that has one, and with ``APPEND_SLASH`` one defined without
+    the request's trailing slash does too, as it would without normalization.
+    """
+    base, sep, query = path.partition('?')
+    strip_slash = settings.APPEND_SLASH and len(base) > 1 and base.endswith('/')
+    variants = [(NORMALIZED, path)]
+    if strip_slash:
+        variants.append((instrumentation.NO_SLASH, base[:-1] + sep + query))
+    variants.append((instrumentation.NO_QUERY, base))
+    if strip_slash:
+        variants.append((instrumentation.NO_SLASH_NO_QUERY, base[:-1]))
+    candidates = []
+    for strategy, variant in variants:
+        key = normalize(variant)
+        if key not in [c[1] for c in candidates]:
+            candidates.append((strategy, key))
+    return candidates
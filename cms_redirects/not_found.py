@@ -0,0 +1,124 @@
+"""
+Buffered logging of 404s that no redirect matched.
+
+When ``REDIRECT_LOG_404`` is enabled the middleware records each unmatched
+path in a per-process buffer, counting repeats and keeping the latest
+referrer.  The buffer holds at most ``REDIRECT_404_BUFFER_SIZE`` distinct
+paths; once it is full further new paths are dropped until the next flush.
+The buffer is written out once ``REDIRECT_404_FLUSH_INTERVAL`` seconds have
+passed since the last flush, so a crawler requesting endless distinct urls
+adds at most ``REDIRECT_404_BUFFER_SIZE`` rows per interval and process.
+"""
+import atexit
+import datetime
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+
+# Keep lookups of already logged paths well under SQLite's limit of 999
+# query parameters.
+LOOKUP_BATCH_SIZE = 500
+
+_buffer = {}
+_lock = threading.Lock()
+_last_flush = [time.time()]
+
+
+def is_enabled():
+    return getattr(settings, 'REDIRECT_LOG_404', False)
+
+
+def record(site_id, path, referrer=''):
+    now = datetime.datetime.now()
+    key = (site_id, path[:200])
+    referrer = referrer[:200]
+    max_size = getattr(settings, 'REDIRECT_404_BUFFER_SIZE', 1000)
+    _lock.acquire()
+    try:
+        entry = _buffer.get(key)
+        if entry is not None:
+            entry[0] += 1
+            entry[1] = now
+            if referrer:
+                entry[2] = referrer
+        elif len(_buffer) < max_size:
+            _buffer[key] = [1, now, referrer]
+    finally:
+        _lock.release()
+    if time.time() - _last_flush[0] >= getattr(settings, 'REDIRECT_404_FLUSH_INTERVAL', 60):
+        flush()
+
+
+def flush():
+    """
+    Writes the buffered 404s to the database.
+    """
+    global _buffer
+    _lock.acquire()
+    try:
+        pending, _buffer = _buffer, {}
+        _last_flush[0] = time.time()
+    finally:
+        _lock.release()
+    if not pending:
+        return
+
+    from cms_redirects.models import MissingPath
+    by_site = {}
+    for site_id, path in pending:
+        by_site.setdefault(site_id, []).append(path)
+    existing = set()
+    for site_id, paths in by_site.items():
+        for i in range(0, len(paths), LOOKUP_BATCH_SIZE):
+            existing.update(MissingPath.objects.filter(site__id__exact=site_id, path__in=paths[i:i + LOOKUP_BATCH_SIZE])
+                            .values_list('site', 'path'))
+
+    table = connection.ops.quote_name(MissingPath._meta.db_table)
+    update_sql = ("UPDATE %s SET hits = hits + %%s, last_hit = %%s, "
+                  "referrer = CASE WHEN %%s = '' THEN referrer ELSE %%s END "
+                  "WHERE site_id = %%s AND path = %%s" % table)
+    insert_sql = "INSERT INTO %s (site_id, path, hits, last_hit, referrer) VALUES (%%s, %%s, %%s, %%s, %%s)" % table
+    updates = []
+    inserts = []
+    for (site_id, path), (count, last_hit, referrer) in pending.items():
+        if (site_id, path) in existing:
+            updates.append((count, last_hit, referrer, referrer, site_id, path))
+        else:
+            inserts.append((site_id, path, count, last_hit, referrer))
+    cursor = connection.cursor()
+    if updates:
+        cursor.executemany(update_sql, updates)
+    transaction.commit_unless_managed()
+    if not inserts:
+        return
+    if try_insert(cursor.executemany, insert_sql, inserts):
+        return
+    # Another process logged some of the same paths since they were looked
+    # up, so insert them one at a time.
+    for site_id, path, count, last_hit, referrer in inserts:
+        if not try_insert(cursor.execute, insert_sql, [site_id, path, count, last_hit, referrer]):
+            cursor.execute(update_sql, [count, last_hit, referrer, referrer, site_id, path])
+            transaction.commit_unless_managed()
+
+
+def try_insert(execute, sql, params):
+    """
+    Runs an insert inside a savepoint, returning False if it was rolled back
+    because a path is already logged.  The savepoint keeps a transaction
+    managed by the caller usable after the failure.
+    """
+    sid = transaction.savepoint()
+    try:
+        execute(sql, params)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        transaction.rollback_unless_managed()
+        return False
+    transaction.savepoint_commit(sid)
+    transaction.commit_unless_managed()
+    return True
+
+
+atexit.register(flush)
@@ -0,0 +1,219 @@
+"""
+Precompiled, memory-mapped redirect maps.
+
+``compile_redirect_map`` writes the exact redirects of every site to the file
+named by ``REDIRECT_MAP_PATH``: a header, a table of record offsets sorted by
+(site, key) and the records themselves.  Workers memory-map the file and
+binary search it, so all processes on a box share one copy in the page cache.
+
+The file is replaced atomically with a rename, and workers check for a new
+file at most every ``REDIRECT_MAP_CHECK_INTERVAL`` seconds.  The map records
+the redirect version stamp it was compiled from; while that differs from the
+current stamp the map is ignored and lookups fall back to the database.
+The stamp is kept in Django's cache, so every process must share one cache
+backend for any but the compiling process to use the map.
+"""
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.utils.encoding import smart_str, smart_unicode
+
+from cms_redirects import cache, instrumentation, normalization
+
+MAGIC = 'CMSRMAP2'
+HEADER = struct.Struct('<8sB32sI')
+OFFSET = struct.Struct('<I')
+RECORD = struct.Struct('<IIIIHHH')
+
+# Stored as the cache max age of redirects that don't set one.
+NO_MAX_AGE = 0xFFFFFFFF
+
+_lock = threading.Lock()
+_state = {'map': None, 'checked': 0, 'stat': None}
+
+logger = logging.getLogger('cms_redirects')
+
+
+class RedirectMap(object):
+    def __init__(self, path):
+        f = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        magic, normalized, version, self.count = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a redirect map" % path)
+        self.normalized = bool(normalized)
+        self.version = version
+        self.offsets = HEADER.size
+
+    def record_key(self, i):
+        offset = OFFSET.unpack_from(self.data, self.offsets + i * OFFSET.size)[0]
+        site_id, pk, page_id, max_age, code, key_len, value_len = RECORD.unpack_from(self.data, offset)
+        start = offset + RECORD.size
+        return (site_id, self.data[start:start + key_len]), offset
+
+    def get(self, site_id, key):
+        target = (site_id, smart_str(key))
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.record_key(mid)[0] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.count:
+            return None
+        found, offset = self.record_key(lo)
+        if found != target:
+            return None
+        site_id, pk, page_id, max_age, code, key_len, value_len = RECORD.unpack_from(self.data, offset)
+        start = offset + RECORD.size + key_len
+        new_path = smart_unicode(self.data[start:start + value_len])
+        if max_age == NO_MAX_AGE:
+            max_age = None
+        return cache.CompactRedirect(pk, page_id or None, new_path, str(code), max_age)
+
+
+class SiteTable(object):
+    """
+    Dict-like view of one site's redirects in a map.
+    """
+    def __init__(self, redirect_map, site_id):
+        self.redirect_map = redirect_map
+        self.site_id = site_id
+
+    def get(self, key, default=None):
+        r = self.redirect_map.get(self.site_id, key)
+        if r is None:
+            return default
+        return r
+
+
+def is_enabled():
+    return bool(getattr(settings, 'REDIRECT_MAP_PATH', None))
+
+
+def uses_process_cache():
+    """
+    Returns whether Django's cache is private to each process, so only the
+    process that compiled the map sees the version stamp it was compiled
+    with.
+    """
+    backend = getattr(settings, 'CACHE_BACKEND', 'locmem://')
+    return backend.split(':', 1)[0] in ('locmem', 'dummy')
+
+
+def get_map():
+    """
+    Returns the current map, reopening the file if it has been replaced, or
+    None if there is no usable map.
+    """
+    path = settings.REDIRECT_MAP_PATH
+    now = time.time()
+    if now - _state['checked'] >= getattr(settings, 'REDIRECT_MAP_CHECK_INTERVAL', 1):
+        _lock.acquire()
+        try:
+            _state['checked'] = now
+            try:
+                st = os.stat(path)
+                stat = (st.st_ino, st.st_mtime, st.st_size)
+            except OSError:
+                stat = None
+            if stat != _state['stat']:
+                _state['stat'] = stat
+                _state['map'] = None
+                if stat:
+                    try:
+                        _state['map'] = RedirectMap(path)
+                        if uses_process_cache():
+                            logger.warning("REDIRECT_MAP_PATH needs a cache backend shared by every "
+                                           "process; other processes will ignore %s", path)
+                    except ValueError:
+                        # Not a map, or one written by another version;
+                        # lookups fall back to the database until it is
+                        # recompiled.
+                        pass
+        finally:
+            _lock.release()
+    return _state['map']
+
+
+def get_table(site_id):
+    """
+    Returns a view of the site's redirects in the map if the map is up to
+    date and was compiled with the current normalization setting.
+    """
+    redirect_map = get_map()
+    if redirect_map is None:
+        return None
+    if redirect_map.normalized != normalization.is_enabled():
+        return None
+    if redirect_map.version != cache.get_version():
+        return None
+    return SiteTable(redirect_map, site_id)
+
+
+def compile_map(path):
+    """
+    Writes every exact redirect to a new map at path, replacing any existing
+    file atomically.  Returns the number of redirects written.
+    """
+    from cms_redirects.models import CMSRedirect
+    version = cache.get_version()
+    normalized = normalization.is_enabled()
+    key_field = normalized and 'normalized_path' or 'old_path'
+    instrumentation.count_query()
+    rows = CMSRedirect.objects.filter(match_type='exact').values_list(
+        'site', key_field, 'pk', 'page', 'cache_max_age', 'response_code', 'new_path')
+    records = []
+    for site_id, key, pk, page_id, max_age, response_code, new_path in rows.iterator():
+        if max_age is None:
+            max_age = NO_MAX_AGE
+        records.append((site_id, smart_str(key), pk, page_id or 0, max_age, int(response_code or 301), smart_str(new_path)))
+    # Where several redirects share a normalized key the oldest one wins.
+    records.sort()
+    unique = []
+    for record in records:
+        if not unique or unique[-1][:2] != record[:2]:
+            unique.append(record)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.redirects')
+    f = os.fdopen(fd, 'wb')
+    written = False
+    try:
+        f.write(HEADER.pack(MAGIC, int(normalized), smart_str(version), len(unique)))
+        offset = HEADER.size + OFFSET.size * len(unique)
+        for site_id, key, pk, page_id, max_age, code, new_path in unique:
+            f.write(OFFSET.pack(offset))
+            offset += RECORD.size + len(key) + len(new_path)
+        for site_id, key, pk, page_id, max_age, code, new_path in unique:
+            f.write(RECORD.pack(site_id, pk, page_id, max_age, code, len(key), len(new_path)))
+            f.write(key)
+            f.write(new_path)
+        f.close()
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+        written = True
+    finally:
+        if not written:
+            f.close()
+            os.remove(tmp_path)
+    return len(unique)
+
+
+def rebuild():
+    """
+    Recompiles the map if one is configured.  Called once changes made by
+    the admin or by commands have committed.
+    """
+    if is_enabled():
+        compile_map(settings.REDIRECT_MAP_PATH)
@@ -0,0 +1,207 @@
+"""
+Redirect maps for the web server.
+
+``export_server_map`` writes a site's exact redirects in a form nginx or
+Apache can serve without reaching Django:
+
+``nginx``
+    Two ``map`` blocks keyed on ``$request_uri``, setting
+    ``$cms_redirect_status`` and ``$cms_redirect_uri``.
+``apache``
+    A ``RewriteMap`` text file mapping each path to ``<status>:<url>``.
+``apache-dbm``
+    The same text file, converted to a DBM map with ``httxt2dbm``.
+
+Page redirects are written with the page's current url and redirects without
+a destination as 410.  The first line of each file records the version stamps
+and a digest of the entries it was written from.  An export is skipped when
+the stamps are unchanged, and the file is left untouched when the entries
+are the same, so a reload hook can watch its modification time.
+"""
+import hashlib
+import os
+import re
+import subprocess
+import tempfile
+
+from django.utils.encoding import smart_str
+
+from cms_redirects import cache
+
+FORMATS = ('nginx', 'apache', 'apache-dbm')
+
+CHUNK_SIZE = 1000
+
+HEADER_RE = re.compile(r'^# cms_redirects site=(\d+) version=(\S+) pages=(\S+) digest=(\w+)$')
+
+# Values that nginx would otherwise read as a parameter or regex.
+NGINX_SPECIAL = ('default', 'hostnames', 'include', 'volatile')
+
+
+def iter_redirects(site_id, chunk_size=CHUNK_SIZE):
+    """
+    Yields (old_path, status, new_url) for every exact redirect of a site,
+    fetching chunk_size rows at a time and resolving page destinations in
+    bulk per chunk.
+    """
+    from cms_redirects.models import CMSRedirect
+    redirects = CMSRedirect.objects.filter(site__id__exact=site_id, match_type='exact').order_by('pk')
+    last_pk = None
+    while True:
+        chunk = redirects
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk.values_list('pk', 'old_path', 'page', 'new_path', 'response_code')[:chunk_size])
+        if not chunk:
+            return
+        page_urls = cache.get_page_urls([row[2] for row in chunk if row[2]])
+        for pk, old_path, page_id, new_path, response_code in chunk:
+            if page_id:
+                new_path = page_urls.get(page_id)
+            if not new_path:
+                yield old_path, '410', ''
+            else:
+                yield old_path, response_code or '301', new_path
+        last_pk = chunk[-1][0]
+
+
+def nginx_quote(value):
+    value = smart_str(value).replace('\\', '\\\\').replace('"', '\\"')
+    if value.startswith('~') or value in NGINX_SPECIAL:
+        value = '\\' + value
+    return '"%s"' % value
+
+
+def write_nginx(f, entries):
+    """
+    Writes both maps, spooling the status map so the entries are only
+    read once.  Returns the number of redirects written.
+    """
+    status = tempfile.TemporaryFile()
+    count = 0
+    try:
+        f.write('map $request_uri $cms_redirect_uri {\n')
+        for old_path, code, new_url in entries:
+            if new_url:
+                f.write('    %s %s;\n' % (nginx_quote(old_path), nginx_quote(new_url)))
+            status.write('    %s %s;\n' % (nginx_quote(old_path), code))
+            count += 1
+        f.write('}\n')
+        f.write('map $request_uri $cms_redirect_status {\n')
+        status.seek(0)
+        for line in status:
+            f.write(line)
+        f.write('}\n')
+    finally:
+        status.close()
+    return count
+
+
+def write_apache(f, entries):
+    """
+    Writes a RewriteMap text file.  Paths containing whitespace can't be
+    keys of a text map and are left out.  Returns the number of redirects
+    written.
+    """
+    count = 0
+    for old_path, code, new_url in entries:
+        old_path = smart_str(old_path)
+        if len(old_path.split()) != 1:
+            continue
+        f.write('%s %s:%s\n' % (old_path, code, smart_str(new_url).replace(' ', '%20') or '-'))
+        count += 1
+    return count
+
+
+def read_header(path):
+    """
+    Returns (site_id, version, page_version, digest) recorded in an
+    existing export, or None.
+    """
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        m = HEADER_RE.match(f.readline().rstrip('\n'))
+    finally:
+        f.close()
+    if m is None:
+        return None
+    return int(m.group(1)), m.group(2), m.group(3), m.group(4)
+
+
+def export_server_map(site_id, path, format='nginx', force=False, chunk_size=CHUNK_SIZE):
+    """
+    Writes the site's redirects to path in the given format.  Returns the
+    number of redirects written, or None if the existing file was already
+    up to date.
+    """
+    if format not in FORMATS:
+        raise ValueError("Unknown format: %s" % format)
+    text_path = path
+    if format == 'apache-dbm':
+        text_path = path + '.txt'
+    version = cache.get_version()
+    page_version = cache.get_version(cache.PAGE_VERSION_KEY)
+    previous = read_header(text_path)
+    if not force and previous is not None and previous[:3] == (site_id, version, page_version):
+        return None
+
+    directory = os.path.dirname(os.path.abspath(text_path))
+    fd, body_path = tempfile.mkstemp(dir=directory, prefix='.redirects')
+    body = os.fdopen(fd, 'w+b')
+    try:
+        if format == 'nginx':
+            count = write_nginx(body, iter_redirects(site_id, chunk_size))
+        else:
+            count = write_apache(body, iter_redirects(site_id, chunk_size))
+        body.seek(0)
+        digest = hashlib.md5()
+        for block in iter(lambda: body.read(65536), ''):
+            digest.update(block)
+        digest = digest.hexdigest()
+        if not force and previous is not None and previous[3] == digest:
+            return None
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.redirects')
+        f = os.fdopen(fd, 'wb')
+        written = False
+        try:
+            f.write('# cms_redirects site=%d version=%s pages=%s digest=%s\n'
+                    % (site_id, version, page_version, digest))
+            body.seek(0)
+            for block in iter(lambda: body.read(65536), ''):
+                f.write(block)
+            f.close()
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, text_path)
+            written = True
+        finally:
+            if not written:
+                f.close()
+                os.remove(tmp_path)
+    finally:
+        body.close()
+        os.remove(body_path)
+
+    if format == 'apache-dbm':
+        write_dbm(text_path, path)
+    return count
+
+
+def write_dbm(text_path, path):
+    """
+    Converts a RewriteMap text file to DBM with Apache's httxt2dbm.
+    """
+    tmp_path = path + '.tmp'
+    try:
+        returncode = subprocess.call(['httxt2dbm', '-i', text_path, '-o', tmp_path])
+    except OSError:
+        raise ValueError("httxt2dbm is needed to write DBM maps")
+    if returncode:
+        raise ValueError("httxt2dbm failed with exit code %d" % returncode)
+    # Depending on the DBM type httxt2dbm writes one or two files.
+    for suffix in ('', '.dir', '.pag', '.db'):
+        if os.path.exists(tmp_path + suffix):
+            os.rename(tmp_path + suffix, path + suffix)
@@ -0,0 +1,13 @@
+from django.dispatch import Signal
+
+# Sent after every redirect lookup while it has receivers.  strategy is the
+# fallback that matched (see cms_redirects.instrumentation) or None for a
+# miss, cache is where the answer came from ('map', 'local', 'negative' or
+# 'db') and duration is in seconds.
+redirect_lookup = Signal(providing_args=["path", "site_id", "redirect", "strategy", "duration", "queries", "cache"])
+
+# Sent when cached redirect responses should be purged from a CDN or
+# caching proxy: after a redirect is saved or deleted, with its surrogate
+# key and path, and after bulk changes, with the key shared by every
+# redirect response and no paths.
+redirect_purge = Signal(providing_args=["keys", "paths", "site_id"])
@@ -1,11 +1,76 @@
+import StringIO
+import csv
+import gzip
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
 import unittest
 
 from django.test.client import Client
+from django.core.handlers.wsgi import WSGIRequest
+from django.core.management import call_command
+from django.core.exceptions import ValidationError
+from django.core.management.base import CommandError
 from django.contrib.sites.models import Site
 from django.conf import settings
+from django.core.cache import cache as django_cache
+from django import http
+from django.db import connection, reset_queries, transaction
+from django.db.models.signals import post_delete, post_save
+from django.utils import translation
 
 from cms.models import Page, Title
-from cms_redirects.models import CMSRedirect
+from cms_redirects.models import CMSRedirect, MissingPath
+from cms_redirects import access_logs, cache, change_log, hits, http_cache, import_check, instrumentation, not_found, redirect_map, warmup
+from cms_redirects.signals import redirect_lookup, redirect_purge
+from cms_redirects.normalization import normalize
+from cms_redirects.middleware import build_response, find_redirect, RedirectFallbackMiddleware
+from cms_redirects.chains import RedirectLoop, find_final_destinations
+
+
+def with_queries(func, *args, **kwargs):
+    """
+    Calls func and returns its result and the queries it ran.
+    """
+    settings.DEBUG = True
+    reset_queries()
+    try:
+        return func(*args, **kwargs), list(connection.queries)
+    finally:
+        settings.DEBUG = False
+
+
+def with_logs(func, *args, **kwargs):
+    """
+    Calls func and returns its result and the messages it logged to the
+    cms_redirects logger.
+    """
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    logger = logging.getLogger('cms_redirects')
+    logger.addHandler(handler)
+    try:
+        return func(*args, **kwargs), [r.getMessage() for r in records]
+    finally:
+        logger.removeHandler(handler)
+
+
+def with_stdout(func, *args, **kwargs):
+    """
+    Calls func and returns what it printed.
+    """
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        func(*args, **kwargs)
+        return sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
 
 class TestRedirects(unittest.TestCase):
     def setUp(self):
@@ -80,3 +145,1188 @@ class TestRedirects(unittest.TestCase):
         r = c.get('/301_page.php?this=is&a=query&string')
         self.assertEqual(r.status_code, 301)
         self.assertEqual(r._headers['location'][1], 'http://testserver')
+
+
+class TestLocalCache(unittest.TestCase):
+    def setUp(self):
+        settings.APPEND_SLASH = False
+        settings.REDIRECT_LOCAL_CACHE = True
+        cache.clear()
+        self.site = Site.objects.get_current()
+
+    def tearDown(self):
+        settings.REDIRECT_LOCAL_CACHE = False
+        CMSRedirect.objects.filter(old_path__startswith='/cached').delete()
+
+    def test_hit_is_served_without_a_query(self):
+        CMSRedirect(site=self.site, new_path='/', old_path='/cached_301.php').save()
+
+        c = Client()
+        r = c.get('/cached_301.php')
+        self.assertEqual(r.status_code, 301)
+
+        r, queries = with_queries(c.get, '/cached_301.php')
+        self.assertEqual(r.status_code, 301)
+        self.assertEqual([q for q in queries if 'cms_redirects' in q['sql']], [])
+
+    def test_save_and_delete_invalidate_table(self):
+        redirect = CMSRedirect(site=self.site, new_path='/first/', old_path='/cached_edit.php')
+        redirect.save()
+
+        c = Client()
+        r = c.get('/cached_edit.php')
+        self.assertEqual(r._headers['location'][1], 'http://testserver/first/')
+
+        redirect.new_path = '/second/'
+        redirect.save()
+        r = c.get('/cached_edit.php')
+        self.assertEqual(r._headers['location'][1], 'http://testserver/second/')
+
+        redirect.delete()
+        self.assertEqual(cache.get_redirect(self.site.id, '/cached_edit.php'), None)
+
+
+class TestCandidateLookup(unittest.TestCase):
+    def setUp(self):
+        settings.APPEND_SLASH = True
+        self.site = Site.objects.get_current()
+
+    def tearDown(self):
+        settings.APPEND_SLASH = False
+        CMSRedirect.objects.filter(old_path__startswith='/candidate').delete()
+
+    def test_fallbacks_resolve_in_one_query(self):
+        CMSRedirect(site=self.site, new_path='/stripped/', old_path='/candidate').save()
+
+        r, queries = with_queries(find_redirect, '/candidate/?page=2')
+        self.assertEqual(r.new_path, '/stripped/')
+        self.assertEqual(len(queries), 1)
+
+    def test_full_path_takes_precedence(self):
+        CMSRedirect(site=self.site, new_path='/stripped/', old_path='/candidate/').save()
+        CMSRedirect(site=self.site, new_path='/full/', old_path='/candidate/?page=2').save()
+
+        self.assertEqual(find_redirect('/candidate/?page=2').new_path, '/full/')
+        self.assertEqual(find_redirect('/candidate/?page=3').new_path, '/stripped/')
+
+
+class TestNegativeCache(unittest.TestCase):
+    def setUp(self):
+        settings.APPEND_SLASH = False
+        settings.REDIRECT_NEGATIVE_CACHE = True
+        cache.clear()
+        self.site = Site.objects.get_current()
+
+    def tearDown(self):
+        settings.REDIRECT_NEGATIVE_CACHE = False
+        CMSRedirect.objects.filter(old_path__startswith='/negative').delete()
+
+    def test_repeated_miss_skips_the_database(self):
+        self.assertEqual(find_redirect('/negative/wp-login.php'), None)
+
+        r, queries = with_queries(find_redirect, '/negative/wp-login.php')
+        self.assertEqual(r, None)
+        self.assertEqual(len(queries), 0)
+
+    def test_saving_a_redirect_evicts_the_miss(self):
+        self.assertEqual(find_redirect('/negative/.env?x=1'), None)
+        CMSRedirect(site=self.site, new_path='/', old_path='/negative/.env').save()
+        self.assertEqual(find_redirect('/negative/.env?x=1').new_path, '/')
+
+
+class TestPageUrlCache(unittest.TestCase):
+    def setUp(self):
+        cache.clear()
+        self.site = Site.objects.get_current()
+
+        page = Page()
+        page.site = self.site
+        page.save()
+        page.publish()
+        self.page = page
+
+        title = Title(title="Hello world!")
+        title.page = page
+        title.language = u'en'
+        title.save()
+        self.title = title
+
+    def count_queries(self, func, *args):
+        return len(with_queries(func, *args)[1])
+
+    def test_page_url_is_cached(self):
+        url = cache.get_page_url(self.page.id)
+        self.assertEqual(self.count_queries(cache.get_page_url, self.page.id), 0)
+        self.assertEqual(cache.get_page_url(self.page.id), url)
+
+    def test_title_save_invalidates_page_url(self):
+        cache.get_page_url(self.page.id)
+        self.title.save()
+        self.assertNotEqual(self.count_queries(cache.get_page_url, self.page.id), 0)
+
+    def test_page_urls_are_loaded_in_batches(self):
+        pages = [self.page]
+        for i in range(2):
+            page = Page(site=self.site)
+            page.save()
+            Title(title="Batched %d" % i, page=page, language=u'en').save()
+            pages.append(page)
+        batch_size, cache.LOOKUP_BATCH_SIZE = cache.LOOKUP_BATCH_SIZE, 2
+        translation.activate('en')
+        try:
+            urls, queries = with_queries(cache.get_page_urls, [page.pk for page in pages])
+        finally:
+            translation.deactivate()
+            cache.LOOKUP_BATCH_SIZE = batch_size
+        self.assertEqual(sorted(urls), sorted(page.pk for page in pages))
+        self.assertEqual(len([q for q in queries if 'FROM "cms_title"' in q['sql']]), 2)
+
+
+class TestBulkImport(unittest.TestCase):
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        fd, self.csv_path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.csv_path)
+        CMSRedirect.objects.filter(old_path__startswith='/bulk').delete()
+
+    def write_csv(self, rows):
+        csv_file = open(self.csv_path, 'wb')
+        writer = csv.writer(csv_file)
+        writer.writerow(['Old Url', 'New Url', 'Response Code'])
+        writer.writerows(rows)
+        csv_file.close()
+
+    def test_bulk_import_inserts_and_updates(self):
+        CMSRedirect(site=self.site, old_path='/bulk/1', new_path='/old/').save()
+        CMSRedirect(site=self.site, old_path='/bulk/2', new_path='/same/').save()
+        self.write_csv([
+            ['/bulk/1', '/new/', '302'],
+            ['/bulk/2', '/same/', '301'],
+            ['/bulk/3', '/added/', '410'],
+        ])
+
+        call_command('import_redirect_csv', self.csv_path, bulk=True, chunk_size=2)
+
+        redirects = dict((r.old_path, (r.new_path, r.response_code))
+                         for r in CMSRedirect.objects.filter(old_path__startswith='/bulk'))
+        self.assertEqual(redirects, {
+            '/bulk/1': ('/new/', '302'),
+            '/bulk/2': ('/same/', '301'),
+            '/bulk/3': ('/added/', '301'),
+        })
+
+    def test_bulk_import_of_large_chunks(self):
+        self.write_csv([['/bulk/large/%d' % i, '/new/', '301'] for i in range(1200)])
+        call_command('import_redirect_csv', self.csv_path, bulk=True, chunk_size=1200)
+        call_command('import_redirect_csv', self.csv_path, bulk=True, chunk_size=1200)
+        self.assertEqual(CMSRedirect.objects.filter(old_path__startswith='/bulk/large/').count(), 1200)
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        self.other_site, created = Site.objects.get_or_create(domain='other.example.com', name='other')
+        fd, self.csv_path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.csv_path)
+        CMSRedirect.objects.filter(old_path__startswith='/export').delete()
+
+    def test_export_round_trips_through_import(self):
+        CMSRedirect(site=self.site, old_path='/export/1', new_path='/one/').save()
+        CMSRedirect(site=self.site, old_path='/export/2', new_path='', response_code='302').save()
+        CMSRedirect(site=self.other_site, old_path='/export/1', new_path='/other/').save()
+        exported = self.redirect_values()
+
+        call_command('redirect_csv', export=True, all_sites=True, output=self.csv_path, chunk_size=1)
+        CMSRedirect.objects.filter(old_path__startswith='/export').delete()
+        call_command('import_redirect_csv', self.csv_path, bulk=True)
+
+        self.assertEqual(self.redirect_values(), exported)
+
+    def test_rules_keep_their_match_type(self):
+        CMSRedirect(site=self.site, old_path='/export/exact', new_path='/one/').save()
+        CMSRedirect(site=self.site, old_path='/export/section/', new_path='/new/', match_type='prefix').save()
+        CMSRedirect(site=self.site, old_path='/export/(\\d+)', new_path='/new/\\1', match_type='regex').save()
+        exported = self.redirect_values()
+
+        call_command('redirect_csv', export=True, output=self.csv_path)
+        CMSRedirect.objects.filter(old_path__startswith='/export').delete()
+        call_command('import_redirect_csv', self.csv_path)
+        self.assertEqual(self.redirect_values(), exported)
+        CMSRedirect.objects.filter(old_path__startswith='/export').delete()
+        call_command('import_redirect_csv', self.csv_path, bulk=True)
+        self.assertEqual(self.redirect_values(), exported)
+        self.assertEqual(import_check.validate_row(1, u'/export/(\\d+)', u'/new/\\1', '301', 'regex'), [])
+        self.assertEqual(len(import_check.validate_row(1, u'/export/(', u'/new/', '301', 'regex')), 1)
+
+    def redirect_values(self):
+        return set(CMSRedirect.objects.filter(old_path__startswith='/export').values_list(
+            'site', 'old_path', 'new_path', 'response_code', 'match_type'))
+
+
+class TestPatternRules(unittest.TestCase):
+    def setUp(self):
+        settings.APPEND_SLASH = False
+        self.site = Site.objects.get_current()
+
+    def tearDown(self):
+        CMSRedirect.objects.filter(old_path__startswith='/news').delete()
+        CMSRedirect.objects.filter(old_path__startswith='^/news').delete()
+
+    def test_longest_prefix_wins(self):
+        CMSRedirect(site=self.site, old_path='/news/', match_type='prefix', new_path='/archive/').save()
+        CMSRedirect(site=self.site, old_path='/news/2009/', match_type='prefix', new_path='/archive/2009/\\1').save()
+
+        self.assertEqual(find_redirect('/news/2009/budget/').new_path, '/archive/2009/budget/')
+        self.assertEqual(find_redirect('/news/2010/budget/').new_path, '/archive/')
+
+    def test_regex_substitutes_groups(self):
+        CMSRedirect(site=self.site, old_path=r'^/news/(\d{4})/(?P<slug>[\w-]+)/$', match_type='regex',
+                    new_path=r'/articles/\g<slug>/?year=\1').save()
+        CMSRedirect(site=self.site, old_path=r'^/news/(.*)$', match_type='regex', new_path='/').save()
+
+        self.assertEqual(find_redirect('/news/2009/budget-cuts/').new_path, '/articles/budget-cuts/?year=2009')
+        self.assertEqual(find_redirect('/news/latest').new_path, '/')
+
+    def test_exact_path_takes_precedence(self):
+        CMSRedirect(site=self.site, old_path='/news/', match_type='prefix', new_path='/archive/').save()
+        CMSRedirect(site=self.site, old_path='/news/today', new_path='/today/').save()
+
+        self.assertEqual(find_redirect('/news/today').new_path, '/today/')
+        self.assertEqual(find_redirect('/news/').new_path, '/archive/')
+
+    def test_rules_that_cannot_be_combined_are_refused(self):
+        for old_path, new_path in [('(?i)^/news/foo', '/'), (r'^/news/(x)\1', '/'),
+                                   (r'^/news/(\d+)', r'/new/\2'), (r'^/news/(\d+)', r'/new/\g<slug>')]:
+            redirect = CMSRedirect(site=self.site, old_path=old_path, new_path=new_path, match_type='regex')
+            self.assertRaises(ValidationError, redirect.clean)
+            self.assertEqual(len(import_check.validate_row(1, old_path, new_path, '301', 'regex')), 1)
+        CMSRedirect(site=self.site, old_path=r'^/news/(\d+)', new_path=r'/new/\1', match_type='regex').clean()
+        self.assertRaises(ValidationError, CMSRedirect(site=self.site, old_path='/news/', new_path=r'/new/\2',
+                                                       match_type='prefix').clean)
+
+    def test_broken_rules_are_skipped(self):
+        # Rules saved before they were validated.
+        CMSRedirect(site=self.site, old_path='(?i)^/news/foo$', match_type='regex', new_path='/foo/').save()
+        CMSRedirect(site=self.site, old_path='^/news/bar$', match_type='regex', new_path='/bar/').save()
+        CMSRedirect(site=self.site, old_path='^/news/a(/b)?$', match_type='regex', new_path=r'/a\1').save()
+        CMSRedirect(site=self.site, old_path='/news/old/', match_type='prefix', new_path=r'/archive/\2').save()
+
+        self.assertEqual(find_redirect('/news/FOO').new_path, '/foo/')
+        self.assertEqual(find_redirect('/news/bar').new_path, '/bar/')
+        self.assertEqual(find_redirect('/news/BAR'), None)
+        self.assertEqual(find_redirect('/news/a/b').new_path, '/a/b')
+        for path in ('/news/a', '/news/old/story'):
+            r, logged = with_logs(find_redirect, path)
+            self.assertEqual(r, None)
+            self.assertEqual(len(logged), 1)
+
+
+class TestEarlyRedirects(unittest.TestCase):
+    def setUp(self):
+        settings.REDIRECT_EARLY = True
+        cache.clear()
+        self.site = Site.objects.get_current()
+
+    def tearDown(self):
+        settings.REDIRECT_EARLY = False
+        settings.REDIRECT_EARLY_ALL = False
+        CMSRedirect.objects.filter(old_path__startswith='/early').delete()
+
+    def get_with_queries(self, path):
+        response, queries = with_queries(Client().get, path)
+        return response, len(queries)
+
+    def test_marked_redirect_skips_page_lookup(self):
+        CMSRedirect(site=self.site, new_path='/', old_path='/early.php', early=True).save()
+
+        Client().get('/early.php')
+        r, num_queries = self.get_with_queries('/early.php')
+        self.assertEqual(r.status_code, 301)
+        self.assertEqual(num_queries, 0)
+
+    def test_unmarked_redirect_waits_for_404(self):
+        CMSRedirect(site=self.site, new_path='/', old_path='/early_unmarked.php').save()
+        self.assertEqual(cache.get_early_table(self.site.id).get('/early_unmarked.php'), None)
+
+        settings.REDIRECT_EARLY_ALL = True
+        self.assertEqual(cache.get_early_table(self.site.id).get('/early_unmarked.php').new_path, '/')
+
+    def test_early_all_matches_the_raw_path(self):
+        CMSRedirect(site=self.site, new_path='/', old_path='/Early/Mixed.php').save()
+        settings.REDIRECT_EARLY_ALL = True
+        settings.REDIRECT_NORMALIZE = True
+        try:
+            table = cache.get_early_table(self.site.id)
+            self.assertEqual(table.get('/Early/Mixed.php').new_path, '/')
+            self.assertEqual(table.get(normalize('/Early/Mixed.php')), None)
+        finally:
+            settings.REDIRECT_NORMALIZE = False
+
+
+class TestChains(unittest.TestCase):
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        fd, self.csv_path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.csv_path)
+        CMSRedirect.objects.filter(old_path__startswith='/chain').delete()
+
+    def write_csv(self, rows):
+        csv_file = open(self.csv_path, 'wb')
+        writer = csv.writer(csv_file)
+        writer.writerow(['Old Url', 'New Url', 'Response Code'])
+        writer.writerows(rows)
+        csv_file.close()
+
+    def test_find_final_destinations(self):
+        final = find_final_destinations({'/a': '/b', '/b': '/c', '/c': '/d', '/x': '/y'})
+        self.assertEqual(final, {'/a': '/d', '/b': '/d'})
+        self.assertRaises(RedirectLoop, find_final_destinations, {'/a': '/b', '/b': '/c', '/c': '/a'})
+
+    def test_import_flattens_chains(self):
+        CMSRedirect(site=self.site, old_path='/chain/2', new_path='/chain/3').save()
+        self.write_csv([['/chain/1', '/chain/2', '301'], ['/chain/3', '/final/', '301']])
+
+        call_command('import_redirect_csv', self.csv_path, bulk=True)
+
+        self.assertEqual(CMSRedirect.objects.get(old_path='/chain/1').new_path, '/final/')
+        self.assertEqual(CMSRedirect.objects.get(old_path='/chain/2').new_path, '/final/')
+
+    def test_import_rejects_loops(self):
+        CMSRedirect(site=self.site, old_path='/chain/2', new_path='/chain/1').save()
+        self.write_csv([['/chain/1', '/chain/2', '301']])
+
+        self.assertRaises(CommandError, call_command, 'import_redirect_csv', self.csv_path)
+        self.assertFalse(CMSRedirect.objects.filter(old_path='/chain/1').exists())
+
+    def test_admin_form_rejects_loops(self):
+        from cms_redirects.admin import CMSRedirectForm
+        CMSRedirect(site=self.site, old_path='/chain/2', new_path='/chain/1').save()
+        form = CMSRedirectForm({'site': self.site.pk, 'old_path': '/chain/1', 'new_path': '/chain/2',
+                                'match_type': 'exact', 'response_code': '301'})
+        self.assertFalse(form.is_valid())
+
+
+class TestHitCounting(unittest.TestCase):
+    def setUp(self):
+        settings.APPEND_SLASH = False
+        settings.REDIRECT_COUNT_HITS = True
+        settings.REDIRECT_HITS_FLUSH_SIZE = 2
+        self.site = Site.objects.get_current()
+
+    def tearDown(self):
+        settings.REDIRECT_COUNT_HITS = False
+        hits.flush()
+        CMSRedirect.objects.filter(old_path__startswith='/hits').delete()
+
+    def test_hits_are_flushed_in_batches(self):
+        first = CMSRedirect(site=self.site, new_path='/', old_path='/hits/1')
+        first.save()
+        second = CMSRedirect(site=self.site, new_path='/', old_path='/hits/2')
+        second.save()
+
+        c = Client()
+        c.get('/hits/1')
+        c.get('/hits/1')
+        self.assertEqual(CMSRedirect.objects.get(pk=first.pk).hits, 0)
+
+        c.get('/hits/2')
+        first = CMSRedirect.objects.get(pk=first.pk)
+        self.assertEqual(first.hits, 2)
+        self.assertNotEqual(first.last_hit, None)
+        self.assertEqual(CMSRedirect.objects.get(pk=second.pk).hits, 1)
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        settings.APPEND_SLASH = True
+        self.site = Site.objects.get_current()
+        self.lookups = []
+        redirect_lookup.connect(self.record_lookup)
+
+    def tearDown(self):
+        settings.APPEND_SLASH = False
+        redirect_lookup.disconnect(self.record_lookup)
+        CMSRedirect.objects.filter(old_path__startswith='/instrumented').delete()
+
+    def record_lookup(self, sender, **kwargs):
+        self.lookups.append(kwargs)
+
+    def test_lookup_reports_strategy_and_queries(self):
+        CMSRedirect(site=self.site, new_path='/', old_path='/instrumented').save()
+        find_redirect('/instrumented/?q=1')
+        find_redirect('/instrumented/missing')
+
+        hit, miss = self.lookups
+        self.assertEqual(hit['strategy'], instrumentation.NO_SLASH_NO_QUERY)
+        self.assertEqual(hit['cache'], 'db')
+        self.assertTrue(hit['queries'] >= 1)
+        self.assertEqual(miss['strategy'], None)
+        self.assertEqual(miss['redirect'], None)
+
+    def test_statsd_lookup_sends_metrics(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(1)
+        settings.REDIRECT_STATSD_HOST, settings.REDIRECT_STATSD_PORT = server.getsockname()
+        redirect_lookup.connect(instrumentation.statsd_lookup)
+        try:
+            find_redirect('/instrumented/missing')
+            packet = server.recv(1024)
+        finally:
+            redirect_lookup.disconnect(instrumentation.statsd_lookup)
+            server.close()
+        self.assertTrue('cms_redirects.strategy.miss:1|c' in packet.split('\n'))
+
+
+class TestNormalizedLookup(unittest.TestCase):
+    def setUp(self):
+        settings.REDIRECT_NORMALIZE = True
+        settings.REDIRECT_NORMALIZE_QUERY = 'sort'
+        cache.clear()
+        self.site = Site.objects.get_current()
+
+    def tearDown(self):
+        settings.REDIRECT_NORMALIZE = False
+        del settings.REDIRECT_NORMALIZE_QUERY
+        settings.REDIRECT_LOCAL_CACHE = False
+        CMSRedirect.objects.filter(normalized_path__startswith='/normal').delete()
+
+    def test_normalize(self):
+        self.assertEqual(normalize('/About/'), '/about')
+        self.assertEqual(normalize('/'), '/')
+        self.assertEqual(normalize('/Search/?b=2&a=1'), '/search?a=1&b=2')
+
+    def test_variants_resolve_with_one_query(self):
+        CMSRedirect(site=self.site, new_path='/about-us/', old_path='/Normal/About/').save()
+        CMSRedirect(site=self.site, new_path='/results/', old_path='/normal/search?a=1&b=2').save()
+
+        r, queries = with_queries(find_redirect, '/normal/about?utm_source=x')
+        self.assertEqual(r.new_path, '/about-us/')
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(find_redirect('/NORMAL/about/').new_path, '/about-us/')
+        self.assertEqual(find_redirect('/normal/search/?b=2&a=1').new_path, '/results/')
+
+    def test_trailing_slash_falls_back_without_slash_normalization(self):
+        settings.REDIRECT_NORMALIZE_SLASH = False
+        append_slash, settings.APPEND_SLASH = settings.APPEND_SLASH, True
+        try:
+            CMSRedirect(site=self.site, new_path='/about-us/', old_path='/normal/about').save()
+            CMSRedirect(site=self.site, new_path='/contact-us/', old_path='/normal/contact/').save()
+            self.assertEqual(find_redirect('/normal/about/').new_path, '/about-us/')
+            self.assertEqual(find_redirect('/normal/about/?utm_source=x').new_path, '/about-us/')
+            self.assertEqual(find_redirect('/normal/contact/').new_path, '/contact-us/')
+            self.assertEqual(find_redirect('/normal/contact'), None)
+        finally:
+            del settings.REDIRECT_NORMALIZE_SLASH
+            settings.APPEND_SLASH = append_slash
+
+    def test_local_table_is_keyed_on_normalized_path(self):
+        settings.REDIRECT_LOCAL_CACHE = True
+        CMSRedirect(site=self.site, new_path='/about-us/', old_path='/Normal/About/').save()
+        self.assertEqual(find_redirect('/normal/about').new_path, '/about-us/')
+
+
+class TestRedirectMap(unittest.TestCase):
+    def setUp(self):
+        settings.APPEND_SLASH = False
+        self.site = Site.objects.get_current()
+        self.map_dir = tempfile.mkdtemp()
+        settings.REDIRECT_MAP_PATH = os.path.join(self.map_dir, 'redirects.map')
+        settings.REDIRECT_MAP_CHECK_INTERVAL = 0
+        # The tests run with a per-process cache, which a map warns about.
+        self.handler = logging.NullHandler()
+        logging.getLogger('cms_redirects').addHandler(self.handler)
+
+    def tearDown(self):
+        logging.getLogger('cms_redirects').removeHandler(self.handler)
+        del settings.REDIRECT_MAP_PATH
+        shutil.rmtree(self.map_dir)
+        CMSRedirect.objects.filter(old_path__startswith='/mapped').delete()
+
+    def test_lookups_use_compiled_map(self):
+        for i in range(20):
+            CMSRedirect(site=self.site, new_path='/new/%d/' % i, old_path='/mapped/%d' % i,
+                        response_code=i % 2 and '302' or '301').save()
+        call_command('compile_redirect_map')
+        find_redirect('/mapped/missing')
+
+        (r, missing), queries = with_queries(map, find_redirect, ['/mapped/7', '/mapped/missing'])
+        self.assertEqual((r.new_path, r.response_code), ('/new/7/', '302'))
+        self.assertEqual(missing, None)
+        self.assertEqual([q for q in queries if 'cms_redirects' in q['sql']], [])
+
+    def test_stale_map_is_ignored(self):
+        redirect = CMSRedirect(site=self.site, new_path='/before/', old_path='/mapped/edit')
+        redirect.save()
+        call_command('compile_redirect_map')
+
+        redirect.new_path = '/after/'
+        redirect.save()
+        self.assertEqual(find_redirect('/mapped/edit').new_path, '/after/')
+
+        call_command('compile_redirect_map')
+        self.assertEqual(find_redirect('/mapped/edit').new_path, '/after/')
+
+    def test_per_process_cache_is_warned_about(self):
+        CMSRedirect(site=self.site, new_path='/new/', old_path='/mapped/warned').save()
+        call_command('compile_redirect_map')
+        backend = settings.CACHE_BACKEND
+        try:
+            settings.CACHE_BACKEND = 'locmem://'
+            self.assertEqual(len(with_logs(redirect_map.get_map)[1]), 1)
+            call_command('compile_redirect_map')
+            settings.CACHE_BACKEND = 'memcached://127.0.0.1:11211/'
+            self.assertEqual(with_logs(redirect_map.get_map)[1], [])
+        finally:
+            settings.CACHE_BACKEND = backend
+
+    def test_admin_changes_rebuild_the_map(self):
+        from django.contrib.auth.models import User
+        user = User.objects.create_superuser('mapper', 'mapper@example.com', 'secret')
+        client = Client()
+        client.login(username='mapper', password='secret')
+        try:
+            client.post('/admin/cms_redirects/cmsredirect/add/', {
+                'site': self.site.pk, 'old_path': '/mapped/admin', 'match_type': 'exact',
+                'new_path': '/new/', 'response_code': '301'})
+            self.assertEqual(redirect_map.get_table(self.site.pk).get('/mapped/admin').new_path, '/new/')
+            redirect = CMSRedirect.objects.get(old_path='/mapped/admin')
+            client.post('/admin/cms_redirects/cmsredirect/%d/delete/' % redirect.pk, {'post': 'yes'})
+            self.assertEqual(redirect_map.get_table(self.site.pk).get('/mapped/admin'), None)
+        finally:
+            user.delete()
+
+
+class TestNewStyleMiddleware(unittest.TestCase):
+    def setUp(self):
+        settings.REDIRECT_EARLY = True
+        cache.clear()
+        self.site = Site.objects.get_current()
+
+    def tearDown(self):
+        settings.REDIRECT_EARLY = False
+        CMSRedirect.objects.filter(old_path__startswith='/newstyle').delete()
+
+    def test_call_short_circuits_early_redirects(self):
+        CMSRedirect(site=self.site, new_path='/', old_path='/newstyle.php', early=True).save()
+        calls = []
+        middleware = RedirectFallbackMiddleware(lambda request: calls.append(request))
+
+        request = WSGIRequest({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/newstyle.php',
+                               'wsgi.input': StringIO.StringIO()})
+        response = middleware(request)
+        self.assertEqual(response.status_code, 301)
+        self.assertEqual(calls, [])
+
+        request = WSGIRequest({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/newstyle_other.php',
+                               'wsgi.input': StringIO.StringIO()})
+        middleware(request)
+        self.assertEqual(calls, [request])
+
+
+class TestServerMaps(unittest.TestCase):
+    def setUp(self):
+        cache.clear()
+        self.site = Site.objects.get_current()
+        self.map_dir = tempfile.mkdtemp()
+        self.map_path = os.path.join(self.map_dir, 'redirects.map')
+
+        page = Page()
+        page.site = self.site
+        page.save()
+        page.publish()
+        self.page = page
+
+        title = Title(title="Hello world!")
+        title.page = page
+        title.language = u'en'
+        title.save()
+
+        CMSRedirect(site=self.site, new_path='/new/', old_path='/served.php').save()
+        CMSRedirect(site=self.site, new_path='/temp/', old_path='/served_temp.php', response_code='302').save()
+        CMSRedirect(site=self.site, page=self.page, old_path='/served_page.php').save()
+        CMSRedirect(site=self.site, new_path='', old_path='/served_gone.php').save()
+
+    def tearDown(self):
+        shutil.rmtree(self.map_dir)
+        CMSRedirect.objects.filter(old_path__startswith='/served').delete()
+
+    def read_map(self):
+        f = open(self.map_path)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_nginx_map(self):
+        call_command('export_server_map', self.map_path)
+        content = self.read_map()
+        uri_map, status_map = content.split('map $request_uri $cms_redirect_status {')
+        self.assertTrue('"/served.php" "/new/";' in uri_map)
+        self.assertTrue('"/served_page.php" "%s";' % cache.get_page_url(self.page.id) in uri_map)
+        self.assertFalse('/served_gone.php' in uri_map)
+        self.assertTrue('"/served_temp.php" 302;' in status_map)
+        self.assertTrue('"/served_gone.php" 410;' in status_map)
+
+    def test_apache_map(self):
+        call_command('export_server_map', self.map_path, format='apache')
+        lines = self.read_map().splitlines()
+        self.assertTrue('/served.php 301:/new/' in lines)
+        self.assertTrue('/served_gone.php 410:-' in lines)
+
+    def test_unchanged_map_is_not_rewritten(self):
+        from cms_redirects.server_maps import export_server_map
+        count = CMSRedirect.objects.filter(site=self.site, match_type='exact').count()
+        self.assertEqual(export_server_map(self.site.id, self.map_path), count)
+        os.utime(self.map_path, (1000, 1000))
+        self.assertEqual(export_server_map(self.site.id, self.map_path), None)
+
+        cache.bump_version()
+        self.assertEqual(export_server_map(self.site.id, self.map_path), None)
+        self.assertEqual(os.stat(self.map_path).st_mtime, 1000)
+
+        CMSRedirect(site=self.site, new_path='/new/', old_path='/served_more.php').save()
+        self.assertEqual(export_server_map(self.site.id, self.map_path), count + 1)
+
+
+class TestAdminChangeList(unittest.TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+        settings.APPEND_SLASH = False
+        self.site = Site.objects.get_current()
+        self.user = User.objects.create_superuser('changelist', 'changelist@example.com', 'secret')
+        self.client = Client()
+        self.client.login(username='changelist', password='secret')
+        for i in range(5):
+            page = Page(site=self.site)
+            page.save()
+            Title(title="Page %d" % i, page=page, language=u'en').save()
+            CMSRedirect(site=self.site, page=page, old_path='/listed/page%d.php' % i).save()
+        CMSRedirect(site=self.site, new_path='/listed/new/', old_path='/listed/other.php').save()
+
+    def tearDown(self):
+        CMSRedirect.objects.filter(old_path__startswith='/listed').delete()
+        self.user.delete()
+
+    def get_changelist(self, **params):
+        response, queries = with_queries(self.client.get, '/admin/cms_redirects/cmsredirect/', params)
+        return response, len(queries)
+
+    def test_page_columns_do_not_query_per_row(self):
+        self.get_changelist()
+        response, few_pages = self.get_changelist(q='/listed/page0')
+        self.assertEqual(response.status_code, 200)
+        response, many_pages = self.get_changelist(q='/listed/')
+        self.assertEqual(few_pages, many_pages)
+        self.assertTrue('Page 4' in response.content)
+
+    def test_search_matches_path_prefixes(self):
+        response, num_queries = self.get_changelist(q='/listed/new')
+        self.assertTrue('/listed/other.php' in response.content)
+        response, num_queries = self.get_changelist(q='other.php')
+        self.assertFalse('/listed/other.php' in response.content)
+
+    def test_large_tables_are_counted_once(self):
+        from cms_redirects import admin as redirect_admin
+        estimated_count = redirect_admin.estimated_count
+        redirect_admin.estimated_count = lambda model: 200000
+        try:
+            response, queries = with_queries(self.client.get, '/admin/cms_redirects/cmsredirect/', {'q': '/listed/'})
+        finally:
+            redirect_admin.estimated_count = estimated_count
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len([q for q in queries if 'COUNT(' in q['sql']]), 1)
+        self.assertTrue('200000 total' in response.content)
+
+    def test_saves_invalidate_caches_after_commit(self):
+        versions = []
+        def record_version(sender, **kwargs):
+            versions.append(cache.get_version())
+        post_save.connect(record_version, sender=CMSRedirect)
+        try:
+            response = self.client.post('/admin/cms_redirects/cmsredirect/add/', {
+                'site': self.site.pk, 'old_path': '/listed/added.php', 'match_type': 'exact',
+                'new_path': '/listed/new/', 'response_code': '301'})
+        finally:
+            post_save.disconnect(record_version, sender=CMSRedirect)
+        self.assertEqual(response.status_code, 302)
+        self.assertNotEqual(cache.get_version(), versions[-1])
+
+    def test_deletes_invalidate_caches_after_commit(self):
+        deleted = CMSRedirect.objects.get(old_path='/listed/other.php')
+        selected = list(CMSRedirect.objects.filter(old_path__startswith='/listed/page').values_list('pk', flat=True))
+        versions = []
+        def record_version(sender, **kwargs):
+            versions.append(cache.get_version())
+        post_delete.connect(record_version, sender=CMSRedirect)
+        try:
+            response = self.client.post('/admin/cms_redirects/cmsredirect/%d/delete/' % deleted.pk, {'post': 'yes'})
+            self.assertEqual(response.status_code, 302)
+            self.assertNotEqual(cache.get_version(), versions[-1])
+            response = self.client.post('/admin/cms_redirects/cmsredirect/', {
+                'action': 'delete_selected', 'post': 'yes', '_selected_action': selected})
+        finally:
+            post_delete.disconnect(record_version, sender=CMSRedirect)
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(CMSRedirect.objects.filter(old_path__startswith='/listed').exists())
+        self.assertNotEqual(cache.get_version(), versions[-1])
+
+
+class TestNotFoundLog(unittest.TestCase):
+    def setUp(self):
+        settings.REDIRECT_LOG_404 = True
+        settings.REDIRECT_404_BUFFER_SIZE = 2
+        self.site = Site.objects.get_current()
+        self.middleware = RedirectFallbackMiddleware()
+        not_found.flush()
+
+    def tearDown(self):
+        settings.REDIRECT_LOG_404 = False
+        del settings.REDIRECT_404_BUFFER_SIZE
+        MissingPath.objects.filter(path__startswith='/lost').delete()
+        CMSRedirect.objects.filter(old_path__startswith='/lost').delete()
+
+    def request_missing(self, path, referrer=None):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'wsgi.input': StringIO.StringIO()}
+        if referrer:
+            environ['HTTP_REFERER'] = referrer
+        return self.middleware.process_exception(WSGIRequest(environ), http.Http404())
+
+    def test_misses_are_counted_per_path(self):
+        self.request_missing('/lost/1.php', 'http://example.com/links')
+        self.request_missing('/lost/1.php')
+        self.request_missing('/lost/2.php')
+        self.assertEqual(MissingPath.objects.filter(path__startswith='/lost').count(), 0)
+
+        not_found.flush()
+        first = MissingPath.objects.get(site=self.site, path='/lost/1.php')
+        self.assertEqual((first.hits, first.referrer), (2, 'http://example.com/links'))
+
+        self.request_missing('/lost/1.php')
+        not_found.flush()
+        self.assertEqual(MissingPath.objects.get(pk=first.pk).hits, 3)
+
+    def test_new_paths_are_inserted_together(self):
+        for i in range(2):
+            self.request_missing('/lost/batch/%d.php' % i)
+        queries = with_queries(not_found.flush)[1]
+        self.assertEqual(len([q for q in queries if 'INSERT' in q['sql']]), 1)
+        self.assertEqual(MissingPath.objects.filter(path__startswith='/lost/batch/').count(), 2)
+
+    def test_buffer_is_bounded(self):
+        for i in range(10):
+            self.request_missing('/lost/storm/%d' % i)
+        not_found.flush()
+        self.assertEqual(MissingPath.objects.filter(path__startswith='/lost/storm/').count(), 2)
+
+    def test_matched_paths_are_not_logged(self):
+        CMSRedirect(site=self.site, new_path='/', old_path='/lost/found.php').save()
+        self.assertEqual(self.request_missing('/lost/found.php').status_code, 301)
+        not_found.flush()
+        self.assertEqual(MissingPath.objects.filter(path='/lost/found.php').count(), 0)
+
+    def test_paths_logged_meanwhile_are_counted(self):
+        self.request_missing('/lost/raced.php')
+        not_found.flush()
+        self.request_missing('/lost/raced.php')
+        # Another process logs the path after flush has looked it up.
+        MissingPath.objects.filter = lambda *args, **kwargs: MissingPath.objects.none()
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            not_found.flush()
+            transaction.commit()
+        finally:
+            transaction.leave_transaction_management()
+            del MissingPath.objects.filter
+        self.assertEqual(MissingPath.objects.get(path='/lost/raced.php').hits, 2)
+
+    def test_admin_action_opens_prefilled_add_forms(self):
+        from django.contrib.auth.models import User
+        for path in ('/lost/popular.php', '/lost/popular.php', '/lost/rare.php'):
+            self.request_missing(path)
+        not_found.flush()
+        selected = list(MissingPath.objects.filter(path__startswith='/lost/').values_list('pk', flat=True))
+
+        user = User.objects.create_superuser('notfound', 'notfound@example.com', 'secret')
+        try:
+            client = Client()
+            client.login(username='notfound', password='secret')
+            response = client.post('/admin/cms_redirects/missingpath/', {
+                'action': 'create_redirects', '_selected_action': selected, 'index': 0})
+            self.assertTrue('/admin/cms_redirects/cmsredirect/add/?' in response['Location'])
+            self.assertFalse(CMSRedirect.objects.filter(old_path__startswith='/lost/').exists())
+            form = client.get(response['Location'])
+            self.assertTrue('value="/lost/popular.php"' in form.content)
+
+            response = client.post(response['Location'], {
+                'site': self.site.pk, 'old_path': '/lost/popular.php', 'match_type': 'exact',
+                'new_path': '/found/', 'response_code': '301'})
+            form = client.get(response['Location'])
+            self.assertTrue('value="/lost/rare.php"' in form.content)
+
+            response = client.post(response['Location'], {
+                'site': self.site.pk, 'old_path': '/lost/rare.php', 'match_type': 'exact',
+                'new_path': '', 'response_code': '301'})
+            self.assertFalse('/add/' in response['Location'])
+        finally:
+            user.delete()
+        self.assertEqual(CMSRedirect.objects.get(old_path='/lost/popular.php').new_path, '/found/')
+        self.assertEqual(MissingPath.objects.filter(path__startswith='/lost/').count(), 0)
+
+
+LOG_LINE = '203.0.113.%d - - [10/Oct/2010:13:55:36 +0000] "GET %s HTTP/1.1" %s 512 "-" "Mozilla/5.0"\n'
+
+
+class TestAccessLogs(unittest.TestCase):
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.plain_path = os.path.join(self.log_dir, 'access.log')
+        self.gzip_path = os.path.join(self.log_dir, 'access.log.1.gz')
+        f = open(self.plain_path, 'wb')
+        for i in range(300):
+            f.write(LOG_LINE % (i % 250, '/popular.php', '404'))
+            if i % 3 == 0:
+                f.write(LOG_LINE % (i % 250, '/less.php?id=1', '404'))
+            f.write(LOG_LINE % (i % 250, '/found/', '200'))
+            f.write(LOG_LINE % (i % 250, '/noise/%d' % i, '404'))
+        f.close()
+        f = gzip.open(self.gzip_path, 'wb')
+        for i in range(150):
+            f.write(LOG_LINE % (1, 'http://example.com/less.php?id=1', '404'))
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def test_split_ranges_count_every_line_once(self):
+        ranges = access_logs.split_logs([self.plain_path], split_size=1000)
+        self.assertTrue(len(ranges) > 10)
+        top = access_logs.TopPaths(1000)
+        for path, start, end in ranges:
+            top.merge(access_logs.count_range((path, start, end, ('404',), 1000)))
+        counts = dict(top.most_common())
+        self.assertEqual(counts['/popular.php'], 300)
+        self.assertEqual(counts['/less.php?id=1'], 100)
+        self.assertEqual(len(counts), 302)
+
+    def test_merged_counts_add_each_error_once(self):
+        top, other = access_logs.TopPaths(2), access_logs.TopPaths(2)
+        top.counts, top.error = {'/both': 5, '/mine': 4}, 2
+        other.counts, other.error = {'/both': 3, '/theirs': 4}, 1
+        top.merge(other)
+        self.assertEqual(top.most_common(), [('/both', 8), ('/theirs', 6)])
+        self.assertEqual(top.error, 5)
+
+    def test_top_paths_are_kept_in_bounded_memory(self):
+        counts = access_logs.count_paths([self.plain_path, self.gzip_path], capacity=2, processes=2)
+        self.assertEqual([path for path, count in counts], ['/popular.php', '/less.php?id=1'])
+        self.assertTrue(counts[0][1] >= 300)
+        self.assertTrue(counts[1][1] >= 250)
+
+    def test_template_csv_is_sorted_by_traffic(self):
+        output = with_stdout(call_command, 'redirect_csv', self.plain_path, self.gzip_path, use_logs=True, top=3)
+        rows = list(csv.reader(StringIO.StringIO(output.strip())))
+        self.assertEqual(rows[0], ['Old Url', 'New Url', 'Response Code'])
+        self.assertEqual([row[0] for row in rows[2:4]], ['/popular.php', '/less.php?id=1'])
+        self.assertEqual(len(rows), 5)
+
+
+class TestImportDryRun(unittest.TestCase):
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        fd, self.csv_path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.csv_path)
+        CMSRedirect.objects.filter(old_path__startswith='/dry').delete()
+
+    def dry_run(self, rows):
+        csv_file = open(self.csv_path, 'wb')
+        writer = csv.writer(csv_file)
+        writer.writerow(['Old Url', 'New Url', 'Response Code'])
+        writer.writerows(rows)
+        csv_file.close()
+        return with_stdout(call_command, 'import_redirect_csv', self.csv_path, dry_run=True)
+
+    def test_report_lists_changes_and_problems(self):
+        CMSRedirect(site=self.site, old_path='/dry/changed', new_path='/before/').save()
+        CMSRedirect(site=self.site, old_path='/dry/same', new_path='/same/').save()
+        CMSRedirect(site=self.site, old_path='/dry/a', new_path='/dry/b').save()
+        before = set(CMSRedirect.objects.filter(old_path__startswith='/dry').values_list('old_path', 'new_path'))
+
+        output = self.dry_run([
+            ['/dry/changed', '/after/', '301'],
+            ['/dry/same', '/same/', '301'],
+            ['/dry/added', '/new/', '302'],
+            ['/dry/added', '/newer/', '302'],
+            ['dry/relative', '/new/', '301'],
+            ['/dry/bad', 'not a url', '307'],
+            ['/dry/b', '/dry/a', '301'],
+        ])
+
+        self.assertTrue("Would add 4 redirects" in output)
+        self.assertTrue("line 5: /dry/added -> /newer/" in output)
+        self.assertTrue("line 2: /dry/changed from /before/ to /after/" in output)
+        self.assertTrue("line 5 repeats line 4: /dry/added" in output)
+        self.assertTrue("line 6: Old Url must be an absolute path" in output)
+        self.assertTrue("line 7: New Url is neither a path nor a valid url" in output)
+        self.assertTrue("line 7: Unknown response code '307'" in output)
+        self.assertTrue("1 redirect loops" in output)
+        self.assertTrue("/dry/a -> /dry/b -> /dry/a" in output or "/dry/b -> /dry/a -> /dry/b" in output)
+        self.assertEqual(set(CMSRedirect.objects.filter(old_path__startswith='/dry').values_list('old_path', 'new_path')), before)
+
+    def test_page_redirects_keep_their_page(self):
+        page = Page(site=self.site)
+        page.save()
+        CMSRedirect(site=self.site, page=page, old_path='/dry/page').save()
+        CMSRedirect(site=self.site, page=page, old_path='/dry/temporary').save()
+        report = import_check.check_import([
+            (2, self.site.pk, u'/dry/page', u'/exported/page/', '301', ''),
+            (3, self.site.pk, u'/dry/temporary', u'/exported/page/', '302', '')])
+        self.assertEqual(report.unchanged, 1)
+        self.assertEqual([row[1] for row in report.changed], [u'/dry/temporary'])
+
+    def test_rows_are_validated_in_parallel(self):
+        rows = [(i, self.site.pk, u'/dry/%d' % i, i % 2 and u'/ok/' or u'bad', '301', '') for i in range(20)]
+        old_threshold, import_check.PARALLEL_THRESHOLD = import_check.PARALLEL_THRESHOLD, 10
+        old_chunk_size, import_check.VALIDATE_CHUNK_SIZE = import_check.VALIDATE_CHUNK_SIZE, 3
+        try:
+            problems = import_check.validate_rows(rows, processes=2)
+        finally:
+            import_check.PARALLEL_THRESHOLD = old_threshold
+            import_check.VALIDATE_CHUNK_SIZE = old_chunk_size
+        self.assertEqual([line for line, message in problems], range(0, 20, 2))
+
+
+class TestSiteByHost(unittest.TestCase):
+    def setUp(self):
+        settings.APPEND_SLASH = False
+        settings.REDIRECT_SITE_BY_HOST = True
+        cache.clear()
+        self.site = Site.objects.get_current()
+        self.other_site, created = Site.objects.get_or_create(domain='other.example.com', name='other')
+        CMSRedirect(site=self.site, new_path='/main/', old_path='/hosted.php').save()
+        CMSRedirect(site=self.other_site, new_path='/other/', old_path='/hosted.php').save()
+
+    def tearDown(self):
+        settings.REDIRECT_SITE_BY_HOST = False
+        CMSRedirect.objects.filter(old_path__startswith='/hosted').delete()
+        Site.objects.filter(domain__startswith='renamed').delete()
+
+    def get_with_queries(self, host):
+        response, queries = with_queries(Client().get, '/hosted.php', HTTP_HOST=host)
+        return response, len([q for q in queries if 'FROM "django_site"' in q['sql']])
+
+    def test_redirects_are_looked_up_on_the_host_site(self):
+        self.assertTrue(self.get_with_queries('other.example.com:8000')[0]['Location'].endswith('/other/'))
+        response, site_queries = self.get_with_queries('OTHER.example.com')
+        self.assertTrue(response['Location'].endswith('/other/'))
+        self.assertEqual(site_queries, 0)
+        self.assertTrue(self.get_with_queries('unknown.example.com')[0]['Location'].endswith('/main/'))
+
+    def test_site_save_invalidates_host_map(self):
+        self.get_with_queries('other.example.com')
+        self.other_site.domain = 'renamed.example.com'
+        self.other_site.save()
+        try:
+            self.assertTrue(self.get_with_queries('renamed.example.com')[0]['Location'].endswith('/other/'))
+        finally:
+            self.other_site.domain = 'other.example.com'
+            self.other_site.save()
+
+
+class TestCachingHeaders(unittest.TestCase):
+    def setUp(self):
+        settings.APPEND_SLASH = False
+        settings.REDIRECT_CACHE_MAX_AGE = {'301': 86400, '410': 3600}
+        settings.REDIRECT_SURROGATE_KEY_HEADER = 'Surrogate-Key'
+        self.site = Site.objects.get_current()
+        self.purged = []
+        redirect_purge.connect(self.record_purge)
+
+    def tearDown(self):
+        del settings.REDIRECT_CACHE_MAX_AGE
+        del settings.REDIRECT_SURROGATE_KEY_HEADER
+        redirect_purge.disconnect(self.record_purge)
+        CMSRedirect.objects.filter(old_path__startswith='/cdn').delete()
+
+    def record_purge(self, sender, keys, paths, site_id, **kwargs):
+        self.purged.append((keys, paths, site_id))
+
+    def test_policy_per_response_code(self):
+        r = CMSRedirect(site=self.site, new_path='/new/', old_path='/cdn/moved.php')
+        r.save()
+        CMSRedirect(site=self.site, new_path='', old_path='/cdn/gone.php').save()
+        CMSRedirect(site=self.site, new_path='/new/', old_path='/cdn/temp.php', response_code='302').save()
+        c = Client()
+
+        response = c.get('/cdn/moved.php')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=86400')
+        self.assertTrue(response.has_header('Expires'))
+        self.assertEqual(response['Surrogate-Key'], 'cms-redirects cms-redirect-%d' % r.pk)
+        self.assertEqual(c.get('/cdn/gone.php')['Cache-Control'], 'public, max-age=3600')
+        self.assertFalse(c.get('/cdn/temp.php').has_header('Cache-Control'))
+
+    def test_redirect_overrides_policy(self):
+        CMSRedirect(site=self.site, new_path='/new/', old_path='/cdn/short.php', cache_max_age=60).save()
+        self.assertEqual(Client().get('/cdn/short.php')['Cache-Control'], 'public, max-age=60')
+
+    def test_save_and_delete_send_purge(self):
+        r = CMSRedirect(site=self.site, new_path='/new/', old_path='/cdn/purged.php')
+        r.save()
+        pk = r.pk
+        r.delete()
+        self.assertEqual(self.purged, [(['cms-redirect-%d' % pk], ['/cdn/purged.php'], self.site.pk)] * 2)
+
+    def test_import_purges_once(self):
+        fd, csv_path = tempfile.mkstemp(suffix='.csv')
+        csv_file = os.fdopen(fd, 'wb')
+        writer = csv.writer(csv_file)
+        writer.writerow(['Old Url', 'New Url', 'Response Code'])
+        writer.writerows([('/cdn/imported%d.php' % i, '/new/', '301') for i in range(3)])
+        csv_file.close()
+        try:
+            call_command('import_redirect_csv', csv_path)
+        finally:
+            os.remove(csv_path)
+        self.assertEqual(self.purged, [([http_cache.ALL_KEY], [], None)])
+
+
+class TestChangeLog(unittest.TestCase):
+    def setUp(self):
+        settings.REDIRECT_LOCAL_CACHE = True
+        settings.REDIRECT_CHANGE_LOG = True
+        cache.clear()
+        self.site = Site.objects.get_current()
+        self.loads = []
+        self.load_table = cache.load_table
+        cache.load_table = self.counting_load_table
+
+    def tearDown(self):
+        cache.load_table = self.load_table
+        settings.REDIRECT_LOCAL_CACHE = False
+        settings.REDIRECT_CHANGE_LOG = False
+        CMSRedirect.objects.filter(old_path__startswith='/logged').delete()
+
+    def counting_load_table(self, *args):
+        self.loads.append(args)
+        return self.load_table(*args)
+
+    def test_changes_are_applied_incrementally(self):
+        moved = CMSRedirect(site=self.site, new_path='/new/', old_path='/logged/moved.php')
+        moved.save()
+        deleted = CMSRedirect(site=self.site, new_path='/new/', old_path='/logged/deleted.php')
+        deleted.save()
+        cache.get_table(self.site.pk)
+        self.assertEqual(len(self.loads), 1)
+
+        moved.old_path = u'/logged/renamed.php'
+        moved.save()
+        deleted.delete()
+        CMSRedirect(site=self.site, new_path='/new/', old_path=u'/logged/added.php').save()
+        table = cache.get_table(self.site.pk)
+        self.assertEqual(len(self.loads), 1)
+        self.assertEqual(table['/logged/renamed.php'].pk, moved.pk)
+        self.assertTrue('/logged/added.php' in table)
+        self.assertFalse('/logged/moved.php' in table)
+        self.assertFalse('/logged/deleted.php' in table)
+        # Keys added from the log are as compact as those of a full load.
+        self.assertTrue(all(type(key) is str for key in table if key.startswith('/logged')))
+
+    def test_truncated_log_reloads(self):
+        cache.get_table(self.site.pk)
+        CMSRedirect(site=self.site, new_path='/new/', old_path='/logged/evicted.php').save()
+        epoch, sequence = change_log.get_position()
+        django_cache.delete(change_log.ENTRY_KEY % (epoch, sequence))
+        self.assertTrue('/logged/evicted.php' in cache.get_table(self.site.pk))
+        self.assertEqual(len(self.loads), 2)
+
+    def test_changes_outside_the_log_reload(self):
+        cache.get_table(self.site.pk)
+        CMSRedirect(site=self.site, new_path='/new/', old_path='/logged/bulk.php').save()
+        cache.bump_version()
+        self.assertTrue('/logged/bulk.php' in cache.get_table(self.site.pk))
+        self.assertEqual(len(self.loads), 2)
+
+
+class TestWarmup(unittest.TestCase):
+    def setUp(self):
+        settings.REDIRECT_LOCAL_CACHE = True
+        cache.clear()
+        self.site = Site.objects.get_current()
+        page = Page(site=self.site)
+        page.save()
+        page.publish()
+        title = Title(title="Warm", language=u'en', page=page)
+        title.save()
+        CMSRedirect(site=self.site, page=page, old_path='/warm/page.php').save()
+        CMSRedirect(site=self.site, new_path='/new/', old_path='/warm/path.php').save()
+
+    def tearDown(self):
+        settings.REDIRECT_LOCAL_CACHE = False
+        CMSRedirect.objects.filter(old_path__startswith='/warm').delete()
+
+    def test_lookups_after_warmup_do_not_query(self):
+        counts = warmup.warm(languages=['en'])
+        self.assertEqual(counts['sites'], 1)
+        self.assertTrue(counts['redirects'] >= 2)
+        translation.activate('en')
+        try:
+            queries = with_queries(map, lambda path: build_response(find_redirect(path, self.site.pk)),
+                                   ['/warm/page.php', '/warm/path.php'])[1]
+        finally:
+            translation.deactivate()
+        self.assertEqual(len(queries), 0)
+
+    def test_command(self):
+        output = with_stdout(call_command, 'warm_redirects', languages='en')
+        self.assertTrue(output.startswith('Loaded '))
+
+    def test_failed_startup_warmup_is_not_raised(self):
+        def fail(*args, **kwargs):
+            raise ValueError("database unavailable")
+        warm = warmup.warm
+        settings.REDIRECT_WARM_ON_STARTUP = True
+        warmup.warm = fail
+        try:
+            logged = with_logs(RedirectFallbackMiddleware)[1]
+        finally:
+            warmup.warm = warm
+            settings.REDIRECT_WARM_ON_STARTUP = False
+        self.assertEqual(logged, ["redirect warmup failed"])
+
+
+class TestCompactTables(unittest.TestCase):
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        CMSRedirect(site=self.site, new_path='/shared/', old_path='/compact/one.php').save()
+        CMSRedirect(site=self.site, new_path='/shared/', old_path='/compact/two.php', response_code='302').save()
+        CMSRedirect(site=self.site, new_path='', old_path=u'/compact/caf\xe9.php').save()
+
+    def tearDown(self):
+        CMSRedirect.objects.filter(old_path__startswith='/compact').delete()
+
+    def test_records_are_compact(self):
+        table = cache.load_table(self.site.pk)
+        one, two = table['/compact/one.php'], table[u'/compact/two.php']
+        self.assertTrue(isinstance(one, cache.CompactRedirect))
+        self.assertEqual((one.response_code, two.response_code), ('301', '302'))
+        self.assertTrue(one.new_path is two.new_path)
+        self.assertEqual(build_response(table[u'/compact/caf\xe9.php']).status_code, 410)
+        self.assertTrue(sys.getsizeof(one) < sys.getsizeof(CMSRedirect.objects.get(pk=one.pk).__dict__))
+
+    def test_memory_report(self):
+        output = with_stdout(call_command, 'redirect_memory_report')
+        self.assertTrue('bytes per redirect' in output)
+        self.assertTrue('as model instances' in output)
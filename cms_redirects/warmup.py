@@ -0,0 +1,68 @@
+"""
+Loading redirect data before traffic arrives.
+
+Otherwise each process builds its local tables, pattern matchers, site map
+and page urls on the 404s that first need them.  ``warm`` loads everything
+the enabled settings will use; call it from your WSGI script once Django is
+set up so it runs before a process serves traffic.  ``REDIRECT_WARM_ON_STARTUP``
+has the middleware call it when it is loaded instead, which Django only does
+while handling the first request.  The ``warm_redirects`` command fills the
+page urls kept in Django's cache for every process.
+"""
+from django.conf import settings
+from django.utils import translation
+
+from cms_redirects import cache, redirect_map
+
+# Keep bulk page lookups well under SQLite's limit of 999 query parameters.
+PAGE_BATCH_SIZE = 500
+
+
+def is_enabled():
+    return getattr(settings, 'REDIRECT_WARM_ON_STARTUP', False)
+
+
+def get_languages():
+    languages = [code for code, name in settings.LANGUAGES]
+    if settings.LANGUAGE_CODE not in languages:
+        languages.append(settings.LANGUAGE_CODE)
+    return languages
+
+
+def warm(site_ids=None, languages=None):
+    """
+    Loads the redirect data of the given sites, or of every site with
+    redirects, and resolves the urls of their pages in the given languages,
+    or every language in settings.LANGUAGES.  Returns a dict of counts.
+    """
+    from cms_redirects.models import CMSRedirect
+    if site_ids is None:
+        site_ids = CMSRedirect.objects.order_by().values_list('site', flat=True).distinct()
+    if languages is None:
+        languages = get_languages()
+    counts = {'sites': 0, 'redirects': 0, 'pages': 0, 'languages': len(languages)}
+
+    if cache.site_by_host_enabled():
+        cache.get_domains()
+    if redirect_map.is_enabled():
+        redirect_map.get_map()
+    for site_id in site_ids:
+        counts['sites'] += 1
+        cache.get_matcher(site_id)
+        if cache.is_enabled():
+            counts['redirects'] += len(cache.get_table(site_id))
+        if getattr(settings, 'REDIRECT_EARLY', False):
+            cache.get_early_table(site_id)
+
+        page_ids = list(CMSRedirect.objects.filter(site__id__exact=site_id, page__isnull=False)
+                        .order_by().values_list('page', flat=True).distinct())
+        counts['pages'] += len(page_ids)
+        current = translation.get_language()
+        try:
+            for language in languages:
+                translation.activate(language)
+                for i in range(0, len(page_ids), PAGE_BATCH_SIZE):
+                    cache.get_page_urls(page_ids[i:i + PAGE_BATCH_SIZE])
+        finally:
+            translation.activate(current)
+    return counts